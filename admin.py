@@ -10,8 +10,25 @@ from backend import Host, db_read_host
 from pathlib import Path
 import argparse
 import re
+import transfer
 
 
+def conflicts(*resources):
+    '''
+    Declare what an update function needs to itself on a host
+    Phases sharing a resource run one after another in appList order;
+    phases without a shared resource run at the same time. Functions that
+    declare nothing are exclusive: they run alone.
+    :param resources: names such as 'pkg' (the package manager lock)
+    :return: decorator setting func.conflicts
+    '''
+    def mark(func):
+        func.conflicts = frozenset(resources)
+        return func
+    return mark
+
+
+@conflicts('pkg')
 def apt_all(host):
     '''
     Structured / formatted collection of system update for apt-get
@@ -19,7 +36,9 @@ def apt_all(host):
     :return: List of formatted strings
     '''
     out = [f'{host.name}: System update:']
-    out.append(f'{host.name}: {apt_update(host.conn)}')
+    if host.staged:
+        out.append(f'{host.name}: packages prefetched, installing only')
+    out.append(f'{host.name}: {apt_update(host.conn, not host.staged)}')
     out.append(f'{host.name}: {apt_upgrade(host.conn)}')
     out.append(f'{host.name} autoremove: {apt_autoremove(host.conn)}')
     check, flag = apt_checkrestart(host)
@@ -92,6 +111,56 @@ def apt_install(host, package):
     return out
 
 
+def apt_plan(host):
+    '''
+    Read-only pending update check for apt-get, changes nothing on host
+    :param host: Host object
+    :return: List of formatted strings, plan dict (pending/security/reboot)
+    '''
+    out = [f'{host.name}: Update plan:']
+    plan = {'pending': None, 'security': 0, 'reboot': False}
+    summary = apt_update(host.conn)
+    out.append(f'{host.name}: {summary}')
+    plan['pending'] = parse_count(summary)
+    if plan['pending'] is None:
+        return out, plan
+    try:
+        command = 'apt-get --just-print upgrade | grep -ci "^Inst.*security"'
+        security = host.conn.run(command, hide=True, warn=True).stdout.strip()
+        plan['security'] = parse_count(security) or 0
+        plan['reboot'] = file_test(host.conn, '/var/run/reboot-required')
+    except exceptions.UnexpectedExit as e:
+        e = parse_e(e)
+        out.append(f'failed: {e}')
+    except ssh_exception.NoValidConnectionsError as e:
+        out.append(f'connection failed: {e}')
+    return out, plan
+
+
+def apt_prefetch(host):
+    '''
+    Download pending upgrades without installing them, at low priority
+    :param host: Host object
+    :return: List of formatted strings, True if all upgrades are staged
+    '''
+    out = [f'{host.name}: Prefetch:']
+    command = 'nice -n 19 ionice -c3 apt-get -y -d upgrade'
+    try:
+        host.conn.sudo('nice -n 19 apt-get update', hide=True)
+        output = host.conn.sudo(command, hide=True).stdout.splitlines()
+        for line in output:
+            if re.search('^[0-9]', line) or re.search('^Download', line):
+                out.append(f'{host.name}: {line}')
+    except exceptions.UnexpectedExit as e:
+        e = parse_e(e)
+        out.append(f'{host.name}: prefetch failed: {e}')
+        return out, False
+    except ssh_exception.NoValidConnectionsError as e:
+        out.append(f'connection failed: {e}')
+        return out, False
+    return out, True
+
+
 def apt_remove(host, package):
     '''
     Remove specified package and dependencies with apt-get
@@ -116,14 +185,16 @@ def apt_remove(host, package):
     return out
 
 
-def apt_update(conn):
+def apt_update(conn, refresh=True):
     '''
     apt-get update
     :param conn: Host instance connection element
+    :param refresh: Refresh package lists first, defaults to True
     :return: Formatted string
     '''
     try:
-        conn.sudo('apt-get update', hide=True)
+        if refresh:
+            conn.sudo('apt-get update', hide=True)
         outlines = conn.run('apt-get --just-print upgrade',
                             hide=True).stdout.splitlines()
         for line in outlines:
@@ -152,6 +223,7 @@ def apt_upgrade(conn):
         return(f'connection failed: {e}')
 
 
+@conflicts('pkg')
 def brew_all(host):
     '''
     Structured / formatted collection of update tasks for Homebrew
@@ -159,8 +231,10 @@ def brew_all(host):
     :return: List of formatted strings
     '''
     out = [f'{host.name}: System update:']
+    if host.staged:
+        out.append(f'{host.name}: packages prefetched, installing only')
     try:
-        brew_count = brew_update(host.conn)
+        brew_count = brew_update(host.conn, not host.staged)
         out.append(f'{host.name}: {brew_count}')
         if re.search('^0', brew_count):
             out.append(f'{host.name}: No packages to upgrade, skipping')
@@ -171,14 +245,52 @@ def brew_all(host):
     return out, False
 
 
-def brew_update(conn):
+def brew_plan(host):
+    '''
+    Read-only pending update check for Homebrew, changes nothing on host
+    :param host: Host object
+    :return: List of formatted strings, plan dict (pending/security/reboot)
+    '''
+    summary = brew_update(host.conn)
+    out = [f'{host.name}: Update plan:', f'{host.name}: {summary}']
+    return out, {'pending': parse_count(summary), 'security': 0,
+                 'reboot': False}
+
+
+def brew_prefetch(host):
+    '''
+    Download outdated Homebrew packages without upgrading, at low priority
+    :param host: Host object
+    :return: List of formatted strings, True if all upgrades are staged
+    '''
+    out = [f'{host.name}: Prefetch:']
+    try:
+        host.conn.run('nice -n 19 /usr/local/bin/brew update', hide=True)
+        outdated = host.conn.run('/usr/local/bin/brew outdated --quiet',
+                                 hide=True).stdout.split()
+        if outdated:
+            host.conn.run('nice -n 19 /usr/local/bin/brew fetch ' +
+                          ' '.join(outdated), hide=True)
+        out.append(f'{host.name}: {len(outdated)} packages downloaded')
+    except exceptions.UnexpectedExit as e:
+        out.append(f'{host.name}: prefetch failed: {e}')
+        return out, False
+    except ssh_exception.NoValidConnectionsError as e:
+        out.append(f'connection failed: {e}')
+        return out, False
+    return out, True
+
+
+def brew_update(conn, refresh=True):
     '''
     Homebrew update / outdated count
     :param conn: Host instance connection element
+    :param refresh: Run brew update first, defaults to True
     :return: Formatted string
     '''
     try:
-        conn.run('/usr/local/bin/brew update', hide=True)
+        if refresh:
+            conn.run('/usr/local/bin/brew update', hide=True)
         brew_com = '/usr/local/bin/brew outdated | wc -l | awk {\'print $1\'}'
         brewstat = conn.run(brew_com, hide=True).stdout.strip()
         return f'{brewstat} packages to update'
@@ -248,6 +360,7 @@ def get_subdirs(conn, directory):
         return dirs[1:]
 
 
+@conflicts()
 def git_all(host):
     '''
     run git_repo() against all repos on host
@@ -303,6 +416,56 @@ def parse_e(e):
     return str(e).split("Stderr:\n\n")[1].split("\n")[0]
 
 
+def pkg_inventory(host, known=None):
+    '''
+    Installed package inventory (dpkg or brew), fetched only if changed
+    :param host: Host object
+    :param known: digest of the inventory already stored for host
+    :return: List of formatted strings, digest, list of (name, version)
+             tuples or None if unchanged / failed
+    '''
+    if host.updater.startswith('brew'):
+        listing = '/usr/local/bin/brew list --versions'
+        digest_com = f'{listing} | shasum | awk {{\'print $1\'}}'
+    else:
+        listing = ('dpkg-query -W -f=\'${db:Status-Abbrev} ${Package} '
+                   '${Version}\\n\'')
+        digest_com = 'sha1sum /var/lib/dpkg/status | awk {\'print $1\'}'
+    try:
+        digest = host.conn.run(digest_com, hide=True).stdout.strip()
+        if digest == known:
+            return [f'{host.name}: inventory unchanged'], digest, None
+        packages = []
+        for line in host.conn.run(listing, hide=True).stdout.splitlines():
+            fields = line.split()
+            if listing.startswith('dpkg'):
+                if len(fields) < 3 or fields[0][1:2] != 'i':
+                    continue
+                fields = fields[1:]
+            if len(fields) > 1:
+                packages.append((fields[0], fields[-1]))
+    except exceptions.UnexpectedExit as e:
+        e = parse_e(e)
+        return [f'{host.name}: inventory failed: {e}'], None, None
+    except ssh_exception.NoValidConnectionsError as e:
+        return [f'{host.name}: connection failed: {e}'], None, None
+    return ([f'{host.name}: inventory updated, {len(packages)} packages'],
+            digest, packages)
+
+
+def parse_count(line):
+    '''
+    Extract the leading package count from apt/brew summary output
+    :param line: Summary string, e.g. "3 upgraded, 0 newly installed..."
+    :return: Integer count, or None if the line has no leading count
+    '''
+    count = re.match('^([0-9]+)', line)
+    if count:
+        return int(count.group(1))
+    return None
+
+
+@conflicts('pkg')
 def pihole_up(host):
     '''
     Update pihole installation
@@ -367,7 +530,8 @@ def repo_list(conn, directory="~/repos/"):
     return repos
 
 
-def script(host, filename, sudo=False, dest=None, execute=True):
+def script(host, filename, sudo=False, dest=None, execute=True,
+           compress=False):
     '''
     Push specified file to hosts and exeecute
     :param host: Host object
@@ -375,6 +539,7 @@ def script(host, filename, sudo=False, dest=None, execute=True):
     :param sudo: Execute with sudo, defaults to False
     :param dest: Destination path, defaults to /tmp/
     :param execute: Execute deployed file, defaults to True
+    :param compress: Compress file in transit, defaults to False
     :return: List of formatted strings
     '''
     out = []
@@ -389,7 +554,8 @@ def script(host, filename, sudo=False, dest=None, execute=True):
             d = Path(f'{dest}/{filename}')
         else:
             d = Path(f'/tmp/{filename}')
-            out.append(host.conn.put(p, str(d), preserve_mode=True))
+        stats = transfer.upload(host.conn, p, str(d), compress is True)
+        out.append(f'{host.name}: {transfer.describe(stats)}')
         if execute is True:
             if sudo is True:
                 outlines = host.conn.sudo(str(d), hide=True).stdout.split('\n')
@@ -406,6 +572,7 @@ def script(host, filename, sudo=False, dest=None, execute=True):
     return out
         
 
+@conflicts()
 def version_check(host):
     '''
     Grab result from ~/bin/distro
@@ -3,9 +3,356 @@
 
 # Imports
 from fabric import Connection, Config
+from invoke.exceptions import CommandTimedOut, UnexpectedExit
+from invoke.runners import Result
+from paramiko import ssh_exception
+from paramiko.config import SSHConfig, SSHConfigDict
+import asyncio
+import json
 import logging
+import math
+import select
+import shlex
+import socket
 import sqlite3
 import os
+import re
+import sys
+import threading
+import time
+import uuid
+
+
+SOCKET_PATH = os.environ.get('NAGA_SOCKET',
+                             os.path.expanduser('~/.naga.sock'))
+
+
+class CircuitOpenError(ssh_exception.NoValidConnectionsError):
+    '''
+    Raised in place of a new connection attempt once a host has failed
+    :param name: hostname from .ssh config
+    :param cause: NoValidConnectionsError from the first failed attempt
+    '''
+    def __init__(self, name, cause):
+        socket.error.__init__(self, None, f'{name} unreachable, skipped')
+        self.errors = cause.errors
+        self.cause = cause
+
+    def __str__(self):
+        return f'{self.args[1]} ({self.cause})'
+
+
+class CachedSSHConfig(SSHConfig):
+    '''
+    SSH client config parsed once and shared by every Connection
+    Lookups are memoised per hostname; the files are parsed again, and the
+    memo dropped, only when one of them changes on disk.
+    :param paths: ssh config files in order of precedence, as Fabric reads
+    '''
+    def __init__(self, paths=('~/.ssh/config', '/etc/ssh/ssh_config')):
+        super().__init__()
+        self.paths = [os.path.expanduser(path) for path in paths]
+        self.lock = threading.Lock()
+        self.stamps = None
+        self.memo = {}
+
+    def stat(self):
+        '''
+        :return: list of (mtime, size) per config file, None if missing
+        '''
+        stamps = []
+        for path in self.paths:
+            try:
+                info = os.stat(path)
+                stamps.append((info.st_mtime_ns, info.st_size))
+            except OSError:
+                stamps.append(None)
+        return stamps
+
+    def refresh(self):
+        '''Parse the config files again if any changed since last parse'''
+        stamps = self.stat()
+        if stamps == self.stamps:
+            return
+        self._config = []
+        for path, stamp in zip(self.paths, stamps):
+            if stamp is not None and os.path.isfile(path):
+                with open(path) as f:
+                    self.parse(f)
+        self.memo = {}
+        self.stamps = stamps
+
+    def lookup(self, hostname):
+        with self.lock:
+            self.refresh()
+            if hostname not in self.memo:
+                self.memo[hostname] = super().lookup(hostname)
+            return SSHConfigDict(self.memo[hostname])
+
+
+SSH_CONFIG = CachedSSHConfig()
+
+
+class HostConnection(Connection):
+    '''
+    Connection with a circuit breaker: after the first failure to connect,
+    every later open() (and so every run/sudo/put) fails immediately
+    '''
+    breaker = None
+    keepalive = None
+    connect_seconds = None
+    _tls = None
+    _open_lock = None
+    # Fabric 2.5 does not declare this one, so setting it on every new
+    # Connection wrote it into the shared Config and forced a full merge
+    inline_ssh_env = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._tls = threading.local()
+        self._open_lock = threading.Lock()
+
+    @property
+    def command_timeout(self):
+        '''Timeout for commands started by the current thread'''
+        return getattr(self._tls, 'timeout', None)
+
+    @command_timeout.setter
+    def command_timeout(self, value):
+        self._tls.timeout = value
+
+    @property
+    def command_deadline(self):
+        '''Unix time no command of the current thread may run past'''
+        return getattr(self._tls, 'deadline', None)
+
+    @command_deadline.setter
+    def command_deadline(self, value):
+        self._tls.deadline = value
+
+    def remaining(self):
+        '''
+        Seconds the next command may run: the phase's command timeout,
+        cut to what is left until the deadline
+        :return: seconds, or None for no limit
+        '''
+        timeout = self.command_timeout
+        if self.command_deadline is not None:
+            left = self.command_deadline - time.time()
+            timeout = left if timeout is None else min(timeout, left)
+        return timeout
+
+    def limited(self, command, timeout=None):
+        '''
+        Apply the current limit to a command about to start
+        :param command: shell command string
+        :param timeout: explicit timeout, instead of remaining()
+        :return: command wrapped by remote_timeout (or as given if there is
+                 no limit), timeout in seconds or None
+        '''
+        if timeout is None:
+            timeout = self.remaining()
+        if timeout is None:
+            return command, None
+        if timeout <= 0:
+            result = Result(command=command, shell='sh', exited=-1,
+                            hide=('stdout', 'stderr'))
+            raise CommandTimedOut(result, 0)
+        return remote_timeout(command, timeout), timeout
+
+    def __setattr__(self, key, value):
+        # DataProxy lists dir(self) on every attribute set; declared
+        # attributes can skip that and go straight to the instance
+        if hasattr(type(self), key):
+            object.__setattr__(self, key, value)
+        else:
+            super().__setattr__(key, value)
+
+    def run(self, command, **kwargs):
+        command, timeout = self.limited(command, kwargs.get('timeout'))
+        return super().run(command, **dict(kwargs, timeout=timeout))
+
+    def sudo(self, command, **kwargs):
+        command, timeout = self.limited(command, kwargs.get('timeout'))
+        return super().sudo(command, **dict(kwargs, timeout=timeout))
+
+    def open(self):
+        # Phases running at the same time share one transport: the first
+        # opens it, the others wait and then find it connected (or broken)
+        with self._open_lock:
+            if self.breaker is not None:
+                raise CircuitOpenError(self.original_host, self.breaker)
+            try:
+                if self.is_connected:
+                    return
+                start = time.time()
+                super().open()
+                self.connect_seconds = time.time() - start
+                if self.keepalive:
+                    self.transport.set_keepalive(self.keepalive)
+            except ssh_exception.NoValidConnectionsError as e:
+                self.breaker = e
+                raise
+            except (socket.error, ssh_exception.SSHException) as e:
+                self.breaker = ssh_exception.NoValidConnectionsError(
+                    {(self.host, self.port): e})
+                raise self.breaker
+
+
+class PersistentShell:
+    '''
+    Connection-compatible wrapper that runs commands over two long-lived
+    remote shells per host - one as the login user for run(), one elevated
+    once with sudo for sudo() - instead of a new channel per command.
+    Anything else (put, sftp, breaker...) is passed to the Connection.
+    :param conn: HostConnection to open the shells over
+    '''
+    def __init__(self, conn):
+        object.__setattr__(self, 'conn', conn)
+        object.__setattr__(self, 'shells', {})
+        object.__setattr__(self, 'locks', {False: threading.Lock(),
+                                           True: threading.Lock()})
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.conn, name, value)
+
+    def close(self):
+        for channel in self.shells.values():
+            channel.close()
+        self.shells.clear()
+        self.conn.close()
+
+    def run(self, command, hide=False, warn=False, timeout=None, **kwargs):
+        '''
+        Run command in the persistent login shell
+        :param command: shell command string
+        :param hide: don't echo output locally
+        :param warn: return non-zero exits instead of raising UnexpectedExit
+        :param timeout: seconds before raising CommandTimedOut
+        :return: invoke Result
+        '''
+        return self.execute(command, False, hide, warn, timeout)
+
+    def sudo(self, command, hide=False, warn=False, timeout=None, **kwargs):
+        '''
+        Run command in the persistent elevated shell
+        :param command: shell command string
+        :param hide: don't echo output locally
+        :param warn: return non-zero exits instead of raising UnexpectedExit
+        :param timeout: seconds before raising CommandTimedOut
+        :return: invoke Result
+        '''
+        return self.execute(command, True, hide, warn, timeout)
+
+    def execute(self, command, sudo, hide, warn, timeout):
+        '''
+        Send one command down a shell and read its framed output
+        Each command runs in a child sh with stdin closed, followed by a
+        unique marker on both streams, carrying the exit status on stdout.
+        '''
+        wrapped, timeout = self.conn.limited(command, timeout)
+        if timeout is None:
+            wrapped = f'sh -c {shlex.quote(command)}'
+        marker = f'__naga_{uuid.uuid4().hex}__'
+        line = (f'{wrapped} </dev/null; '
+                f'printf "\\n{marker} %d\\n" $?; '
+                f'printf "\\n{marker}\\n" >&2\n')
+        frame = re.compile(f'\n{marker} (-?[0-9]+)\n$'.encode())
+
+        def framed(stdout, stderr):
+            return (frame.search(stdout) is not None and
+                    stderr.endswith(f'\n{marker}\n'.encode()))
+
+        with self.locks[sudo]:
+            channel = self.shell(sudo)
+            channel.sendall(line.encode())
+            try:
+                stdout, stderr = self.read_until(channel, framed, timeout)
+            except CommandTimedOut:
+                self.shells.pop(sudo).close()
+                result = Result(command=command, shell='sh', exited=-1,
+                                hide=('stdout', 'stderr'))
+                raise CommandTimedOut(result, timeout)
+        status = int(frame.search(stdout).group(1))
+        stdout = stdout[:frame.search(stdout).start()].decode(errors='replace')
+        stderr = stderr.rsplit(f'\n{marker}'.encode(), 1)[0]
+        stderr = stderr.decode(errors='replace')
+        if not hide:
+            sys.stdout.write(stdout)
+            sys.stderr.write(stderr)
+        result = Result(stdout=stdout, stderr=stderr, command=command,
+                        shell='sh', exited=status, hide=('stdout', 'stderr'))
+        if result.exited != 0 and not warn:
+            raise UnexpectedExit(result)
+        return result
+
+    def shell(self, sudo):
+        '''
+        Return the open login or elevated shell channel, starting it once
+        :param sudo: True for the elevated shell
+        :return: paramiko Channel
+        '''
+        channel = self.shells.get(sudo)
+        if channel is not None and not channel.closed:
+            return channel
+        self.conn.open()
+        channel = self.conn.transport.open_session()
+        ready = f'__naga_{uuid.uuid4().hex}__'.encode()
+        start = f"sh -c 'echo {ready.decode()}; exec sh'"
+        if sudo:
+            prompt = b'[sudo] naga password: '
+            channel.exec_command(f"sudo -S -H -p '{prompt.decode()}' {start}")
+            stdout, stderr = self.read_until(
+                channel, lambda out, err: ready in out or prompt in err, 30)
+            if ready not in stdout:
+                channel.sendall(f'{self.conn.config.sudo.password}\n')
+                stdout, stderr = self.read_until(
+                    channel,
+                    lambda out, err: ready in out or err.count(prompt) > 1,
+                    30)
+            if ready not in stdout:
+                channel.close()
+                raise UnexpectedExit(Result(
+                    stderr='sudo: incorrect password', command=start,
+                    shell='sh', exited=1, hide=('stdout', 'stderr')))
+        else:
+            channel.exec_command(start)
+            self.read_until(channel, lambda out, err: ready in out, 30)
+        self.shells[sudo] = channel
+        return channel
+
+    def read_until(self, channel, done, timeout=None):
+        '''
+        Read stdout and stderr from channel until done(stdout, stderr)
+        :param channel: paramiko Channel
+        :param done: predicate on the stdout and stderr bytes read so far
+        :param timeout: seconds before raising CommandTimedOut
+        :return: stdout, stderr bytes
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        stdout = stderr = b''
+        while True:
+            while channel.recv_ready():
+                stdout += channel.recv(65536)
+            while channel.recv_stderr_ready():
+                stderr += channel.recv_stderr(65536)
+            if done(stdout, stderr):
+                return stdout, stderr
+            if channel.exit_status_ready():
+                raise UnexpectedExit(Result(
+                    stdout=stdout.decode(errors='replace'),
+                    stderr=stderr.decode(errors='replace'), shell='sh',
+                    exited=channel.recv_exit_status(),
+                    hide=('stdout', 'stderr')))
+            wait = 1
+            if deadline is not None:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    raise CommandTimedOut(Result(), timeout)
+            select.select([channel], [], [], min(wait, 1))
 
 
 class Host:
@@ -22,8 +369,12 @@ class Host:
         self.updater = updater
         self.appList = appList
         self.configuration = configuration
-        self.conn = Connection(name, config=configuration)
+        self.conn = HostConnection(name, config=configuration)
+        if configuration is not None and \
+                configuration.get('naga', {}).get('persistent'):
+            self.conn = PersistentShell(self.conn)
         self.children = children
+        self.staged = False
 
 
 class sqlite_connection(object):
@@ -66,6 +417,100 @@ def db_connector(func):
     return with_connection_
 
 
+def remote_timeout(command, seconds, grace=5):
+    '''
+    Wrap command so the remote host stops it too once it overruns
+    On CommandTimedOut Fabric only closes the channel; with no pty the
+    remote process gets no SIGHUP and would keep running (and holding
+    e.g. the dpkg lock). timeout(1) sends its process group SIGTERM grace
+    seconds after naga gives up, then SIGKILL after another grace period.
+    Hosts without timeout(1) run the command unwrapped.
+    :param command: shell command string
+    :param seconds: local timeout of the command
+    :param grace: seconds between local timeout, SIGTERM and SIGKILL
+    :return: shell command string
+    '''
+    limit = math.ceil(seconds) + grace
+    script = (f'if command -v timeout >/dev/null 2>&1; then '
+              f'exec timeout -k {grace} {limit} sh -c "$1"; '
+              f'else exec sh -c "$1"; fi')
+    return f'sh -c {shlex.quote(script)} naga {shlex.quote(command)}'
+
+
+async def probe(address, port, timeout, limit):
+    '''
+    Check that an SSH server answers with its banner
+    :param address: hostname or IP address to connect to
+    :param port: SSH port
+    :param timeout: seconds to wait for connection and banner
+    :param limit: asyncio.Semaphore bounding concurrent sockets
+    :return: banner string, or None if unreachable
+    '''
+    async with limit:
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(address, port), timeout)
+        except (OSError, asyncio.TimeoutError):
+            return None
+        try:
+            banner = await asyncio.wait_for(reader.readline(), timeout)
+        except (OSError, asyncio.TimeoutError):
+            banner = b''
+        finally:
+            writer.close()
+    banner = banner.decode(errors='replace').strip()
+    if banner.startswith('SSH-'):
+        return banner
+    return None
+
+
+def probe_hosts(hosts, timeout=3, concurrency=256):
+    '''
+    Probe SSH port and banner of hosts concurrently
+    Hosts reached through a gateway/ProxyCommand cannot be probed directly
+    and are reported as reachable.
+    :param hosts: list of Host objects
+    :param timeout: seconds to wait per host
+    :param concurrency: maximum sockets open at once
+    :return: dict of hostname: banner string or None if unreachable
+    '''
+    async def probe_all():
+        limit = asyncio.Semaphore(concurrency)
+        return await asyncio.gather(*[
+            probe(host.conn.host, host.conn.port, timeout, limit)
+            for host in direct])
+
+    results = {host.name: 'via gateway' for host in hosts if host.conn.gateway}
+    direct = [host for host in hosts if not host.conn.gateway]
+    if direct:
+        banners = asyncio.run(probe_all())
+        results.update(zip([host.name for host in direct], banners))
+    return results
+
+
+def daemon_request(request, path=SOCKET_PATH):
+    '''
+    Send request to the resident naga daemon, if one is running
+    :param request: dict with 'command', 'hosts' and optional 'args'
+    :param path: Unix socket the daemon listens on
+    :return: response dict, or None if no daemon serves this database
+    '''
+    if not os.path.exists(path):
+        return None
+    request['database'] = os.path.abspath(os.environ.get('CONN', 'hosts.db'))
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(path)
+            s.sendall((json.dumps(request) + '\n').encode())
+            response = json.loads(s.makefile('rb').readline())
+    except (OSError, ValueError):
+        return None
+    if 'error' in response:
+        logging.warning(f'naga daemon: {response["error"]}')
+        return None
+    return response
+
+
 @db_connector
 def db_add_app(db, host_id, app):
     '''
@@ -79,6 +524,116 @@ def db_add_app(db, host_id, app):
     c.execute(apps_sql, (host_id, app))
 
 
+@db_connector
+def db_add_history(db, hostname, phase, seconds):
+    '''
+    Record how long a host phase took
+    :param db: DB Connector (use db_connector func)
+    :param hostname: hostname the phase ran on
+    :param phase: bare function name of the phase
+    :param seconds: wall time of the phase
+    '''
+    sql = '''INSERT INTO history(host,phase,seconds,finished)
+             VALUES(?,?,?,?)'''
+    c = db.cursor()
+    c.execute(sql, (hostname, phase, seconds, time.time()))
+
+
+@db_connector
+def db_add_inventory(db, host_id, digest, packages):
+    '''
+    Replace stored package inventory for host in a single transaction
+    :param db: DB Connector (use db_connector func)
+    :param host_id: DB rowid for host
+    :param digest: remote hash of the package list the inventory came from
+    :param packages: list of (name, version) tuples
+    '''
+    delete_sql = '''DELETE FROM packages WHERE host = ?'''
+    package_sql = '''INSERT OR REPLACE INTO packages(host,name,version)
+                     VALUES(?,?,?)'''
+    inventory_sql = '''INSERT OR REPLACE INTO inventory(host,digest,refreshed)
+                       VALUES(?,?,?)'''
+    c = db.cursor()
+    c.execute(delete_sql, (host_id,))
+    c.executemany(package_sql, [(host_id, name, version)
+                                for name, version in packages])
+    c.execute(inventory_sql, (host_id, digest, time.time()))
+
+
+@db_connector
+def db_add_job(db, hosts):
+    '''
+    Record start of a fleet run in db
+    :param db: DB Connector (use db_connector func)
+    :param hosts: list of hostnames in the run
+    :return: job id
+    '''
+    job_sql = '''INSERT INTO jobs(started,hosts) VALUES(?,?)'''
+    c = db.cursor()
+    c.execute(job_sql, (time.time(), ','.join(hosts)))
+    return c.lastrowid
+
+
+@db_connector
+def db_add_checkpoint(db, job_id, hostname, phase, status, reboot=False):
+    '''
+    Record completion of one host phase of a fleet run
+    :param db: DB Connector (use db_connector func)
+    :param job_id: id of the fleet run
+    :param hostname: hostname the phase ran on
+    :param phase: bare function name of the phase
+    :param status: 'done', 'skipped', 'failed' or 'unreachable'
+    :param reboot: True if the phase found the host needs a reboot
+    '''
+    sql = '''INSERT OR REPLACE INTO checkpoints(job,host,phase,status,reboot,
+             finished) VALUES(?,?,?,?,?,?)'''
+    c = db.cursor()
+    c.execute(sql, (job_id, hostname, phase, status, int(reboot), time.time()))
+
+
+@db_connector
+def db_add_plan(db, host_id, plan):
+    '''
+    Cache pending update plan for host in db, timestamped now
+    :param db: DB Connector (use db_connector func)
+    :param host_id: DB rowid for host
+    :param plan: plan dict from admin *_plan functions
+    '''
+    plan_sql = '''INSERT OR REPLACE INTO plans(host,pending,security,reboot,
+                 checked) VALUES(?,?,?,?,?)'''
+    c = db.cursor()
+    c.execute(plan_sql, (host_id, plan['pending'], plan['security'],
+                         int(plan['reboot']), time.time()))
+
+
+@db_connector
+def db_add_prefetch(db, host_id, staged):
+    '''
+    Record whether host has all pending upgrades downloaded
+    :param db: DB Connector (use db_connector func)
+    :param host_id: DB rowid for host
+    :param staged: True if every pending upgrade is in the package cache
+    '''
+    sql = '''INSERT OR REPLACE INTO prefetch(host,staged,checked)
+             VALUES(?,?,?)'''
+    c = db.cursor()
+    c.execute(sql, (host_id, int(staged), time.time()))
+
+
+@db_connector
+def db_add_reachability(db, host_id, banner):
+    '''
+    Cache pre-flight probe result for host in db, timestamped now
+    :param db: DB Connector (use db_connector func)
+    :param host_id: DB rowid for host
+    :param banner: SSH banner string, or None if unreachable
+    '''
+    sql = '''INSERT OR REPLACE INTO reachability(host,reachable,banner,checked)
+             VALUES(?,?,?,?)'''
+    c = db.cursor()
+    c.execute(sql, (host_id, int(banner is not None), banner, time.time()))
+
+
 @db_connector
 def db_add_child(db, parent_id, child_id):
     '''
@@ -144,8 +699,90 @@ def db_create_db():
         function text NOT NULL
     );
     '''
+    plans_table_sql = '''
+    CREATE TABLE IF NOT EXISTS plans (
+        host integer PRIMARY KEY,
+        pending integer,
+        security integer NOT NULL,
+        reboot integer NOT NULL,
+        checked real NOT NULL
+    );
+    '''
     db_create_table('', hosts_table_sql)
     db_create_table('', apps_table_sql)
+    packages_table_sql = '''
+    CREATE TABLE IF NOT EXISTS packages (
+        host integer NOT NULL,
+        name text NOT NULL,
+        version text,
+        PRIMARY KEY (host, name)
+    );
+    '''
+    packages_index_sql = '''
+    CREATE INDEX IF NOT EXISTS packages_name ON packages (name);
+    '''
+    inventory_table_sql = '''
+    CREATE TABLE IF NOT EXISTS inventory (
+        host integer PRIMARY KEY,
+        digest text NOT NULL,
+        refreshed real NOT NULL
+    );
+    '''
+    reachability_table_sql = '''
+    CREATE TABLE IF NOT EXISTS reachability (
+        host integer PRIMARY KEY,
+        reachable integer NOT NULL,
+        banner text,
+        checked real NOT NULL
+    );
+    '''
+    jobs_table_sql = '''
+    CREATE TABLE IF NOT EXISTS jobs (
+        id integer PRIMARY KEY,
+        started real NOT NULL,
+        finished real,
+        hosts text NOT NULL
+    );
+    '''
+    checkpoints_table_sql = '''
+    CREATE TABLE IF NOT EXISTS checkpoints (
+        job integer NOT NULL,
+        host text NOT NULL,
+        phase text NOT NULL,
+        status text NOT NULL,
+        reboot integer NOT NULL,
+        finished real NOT NULL,
+        PRIMARY KEY (job, host, phase)
+    );
+    '''
+    history_table_sql = '''
+    CREATE TABLE IF NOT EXISTS history (
+        host text NOT NULL,
+        phase text NOT NULL,
+        seconds real NOT NULL,
+        finished real NOT NULL
+    );
+    '''
+    history_index_sql = '''
+    CREATE INDEX IF NOT EXISTS history_phase ON history (host, phase, finished);
+    '''
+    prefetch_table_sql = '''
+    CREATE TABLE IF NOT EXISTS prefetch (
+        host integer PRIMARY KEY,
+        staged integer NOT NULL,
+        checked real NOT NULL
+    );
+    '''
+    db_create_table('', plans_table_sql)
+    db_create_table('', prefetch_table_sql)
+    db_create_table('', history_table_sql)
+    db_create_table('', history_index_sql)
+    db_create_table('', jobs_table_sql)
+    db_create_table('', checkpoints_table_sql)
+    db_create_table('', reachability_table_sql)
+    db_create_table('', packages_table_sql)
+    db_create_table('', packages_index_sql)
+    db_create_table('', inventory_table_sql)
 
 
 @db_connector
@@ -197,9 +834,42 @@ def db_delete_host(db, host_id):
     '''
     sql_hosts = '''DELETE FROM hosts WHERE id=?'''
     sql_app = '''DELETE FROM apps WHERE host=?'''
+    sql_plan = '''DELETE FROM plans WHERE host=?'''
+    sql_packages = '''DELETE FROM packages WHERE host=?'''
+    sql_inventory = '''DELETE FROM inventory WHERE host=?'''
+    sql_reachability = '''DELETE FROM reachability WHERE host=?'''
+    sql_prefetch = '''DELETE FROM prefetch WHERE host=?'''
     c = db.cursor()
     c.execute(sql_hosts, (host_id,))
     c.execute(sql_app, (host_id,))
+    c.execute(sql_plan, (host_id,))
+    c.execute(sql_packages, (host_id,))
+    c.execute(sql_inventory, (host_id,))
+    c.execute(sql_reachability, (host_id,))
+    c.execute(sql_prefetch, (host_id,))
+
+
+@db_connector
+def db_export_hosts(db):
+    '''
+    Read every host with its apps and parent for an inventory file
+    :param db: DB Connector (use db_connector func)
+    :return: list of dicts with 'name', 'updater', 'apps' and 'parent'
+    '''
+    c = db.cursor()
+    c.execute('''SELECT id, name, updater, children FROM hosts
+                 ORDER BY name''')
+    hosts = c.fetchall()
+    c.execute('''SELECT host, function FROM apps ORDER BY id''')
+    apps = {}
+    for host_id, function in c.fetchall():
+        apps.setdefault(host_id, []).append(function)
+    names = {host_id: name for host_id, name, _, _ in hosts}
+    parents = {child: names[host_id] for host_id, _, _, children in hosts
+               for child in split_children(children)}
+    return [{'name': name, 'updater': updater, 'apps': apps.get(host_id, []),
+             'parent': parents.get(host_id, '')}
+            for host_id, name, updater, _ in hosts]
 
 
 @db_connector
@@ -233,6 +903,146 @@ def db_fetch_children(db, host_id):
     return c.fetchone()[0].split(',')
 
 
+@db_connector
+def db_fetch_inventory_digest(db, host_id):
+    '''
+    Get hash of the package list last stored for host_id
+    :param db: DB Connector (use db_connector func)
+    :param host_id: host_id for host to query
+    :return: digest string or None if never inventoried
+    '''
+    sql = '''SELECT digest FROM inventory WHERE host=?'''
+    c = db.cursor()
+    c.execute(sql, (host_id,))
+    digest = c.fetchone()
+    if digest:
+        return digest[0]
+    else:
+        return None
+
+
+@db_connector
+def db_fetch_packages(db, pattern):
+    '''
+    Query stored inventories for installed packages across all hosts
+    :param db: DB Connector (use db_connector func)
+    :param pattern: package name, shell-style wildcards (*, ?) allowed
+    :return: list of (hostname, package, version) tuples
+    '''
+    sql = '''SELECT hosts.name, packages.name, packages.version
+             FROM packages JOIN hosts ON hosts.id = packages.host
+             WHERE packages.name GLOB ?
+             ORDER BY packages.name, hosts.name'''
+    c = db.cursor()
+    c.execute(sql, (pattern,))
+    return c.fetchall()
+
+
+@db_connector
+def db_fetch_job(db, job_id=None):
+    '''
+    Read a fleet run and its checkpoints from db
+    :param db: DB Connector (use db_connector func)
+    :param job_id: id of the fleet run, or None for the most recent
+    :return: dict with 'id', 'hosts', 'finished', 'done' (hostname: set of
+             completed phases) and 'reboot' (hostnames), or None
+    '''
+    if job_id is None:
+        job_sql = '''SELECT id, hosts, finished FROM jobs
+                     ORDER BY id DESC LIMIT 1'''
+        params = ()
+    else:
+        job_sql = '''SELECT id, hosts, finished FROM jobs WHERE id=?'''
+        params = (job_id,)
+    checkpoint_sql = '''SELECT host, phase, status, reboot FROM checkpoints
+                        WHERE job=?'''
+    c = db.cursor()
+    c.execute(job_sql, params)
+    row = c.fetchone()
+    if row is None:
+        return None
+    job = {'id': row[0], 'hosts': row[1].split(','), 'finished': row[2],
+           'done': {}, 'reboot': []}
+    c.execute(checkpoint_sql, (job['id'],))
+    for host, phase, status, reboot in c.fetchall():
+        if status in ('done', 'skipped'):
+            job['done'].setdefault(host, set()).add(phase)
+        if reboot and host not in job['reboot']:
+            job['reboot'].append(host)
+    return job
+
+
+@db_connector
+def db_finish_job(db, job_id):
+    '''
+    Mark a fleet run as having reached the end of its host list
+    :param db: DB Connector (use db_connector func)
+    :param job_id: id of the fleet run
+    '''
+    sql = '''UPDATE jobs SET finished = ? WHERE id = ?'''
+    c = db.cursor()
+    c.execute(sql, (time.time(), job_id))
+
+
+@db_connector
+def db_fetch_phases(db, host_id):
+    '''
+    Get the phases an update run executes for host_id
+    :param db: DB Connector (use db_connector func)
+    :param host_id: host_id for host to query
+    :return: list of function names, updater first
+    '''
+    sql_hosts = '''SELECT updater FROM hosts WHERE id = ?'''
+    sql_apps = '''SELECT function FROM apps WHERE host = ?'''
+    c = db.cursor()
+    c.execute(sql_hosts, (host_id,))
+    row = c.fetchone()
+    if row is None:
+        return []
+    c.execute(sql_apps, (host_id,))
+    return [row[0]] + [app[0] for app in c.fetchall()]
+
+
+@db_connector
+def db_fetch_plan(db, host_id, max_age=None):
+    '''
+    Get cached pending update plan for host_id
+    :param db: DB Connector (use db_connector func)
+    :param host_id: host_id for host to query
+    :param max_age: ignore plans older than this many seconds (None for any)
+    :return: plan dict with 'checked' timestamp, or None
+    '''
+    sql = '''SELECT pending, security, reboot, checked FROM plans
+             WHERE host=?'''
+    c = db.cursor()
+    c.execute(sql, (host_id,))
+    row = c.fetchone()
+    if row is None:
+        return None
+    pending, security, reboot, checked = row
+    if max_age is not None and time.time() - checked > max_age:
+        return None
+    return {'pending': pending, 'security': security,
+            'reboot': bool(reboot), 'checked': checked}
+
+
+@db_connector
+def db_fetch_history(db, hostname, phase, limit=50):
+    '''
+    Get recent durations of a host phase
+    :param db: DB Connector (use db_connector func)
+    :param hostname: hostname the phase ran on
+    :param phase: bare function name of the phase
+    :param limit: number of most recent runs to return
+    :return: list of seconds, newest first
+    '''
+    sql = '''SELECT seconds FROM history WHERE host=? AND phase=?
+             ORDER BY finished DESC LIMIT ?'''
+    c = db.cursor()
+    c.execute(sql, (hostname, phase, limit))
+    return [row[0] for row in c.fetchall()]
+
+
 @db_connector
 def db_fetch_hostid(db, hostname):
     '''
@@ -305,6 +1115,130 @@ def db_fetch_parent_id(db, child_id):
         return None
 
 
+@db_connector
+def db_fetch_staged(db, host_id, max_age=None):
+    '''
+    Check whether host has all pending upgrades downloaded
+    :param db: DB Connector (use db_connector func)
+    :param host_id: host_id for host to query
+    :param max_age: ignore prefetches older than this many seconds
+    :return: True if staged
+    '''
+    sql = '''SELECT staged, checked FROM prefetch WHERE host=?'''
+    c = db.cursor()
+    c.execute(sql, (host_id,))
+    row = c.fetchone()
+    if row is None:
+        return False
+    staged, checked = row
+    if max_age is not None and time.time() - checked > max_age:
+        return False
+    return bool(staged)
+
+
+@db_connector
+def db_fetch_reachability(db, host_id, max_age=None):
+    '''
+    Get cached pre-flight probe result for host_id
+    :param db: DB Connector (use db_connector func)
+    :param host_id: host_id for host to query
+    :param max_age: ignore results older than this many seconds (None for any)
+    :return: dict with 'reachable', 'banner' and 'checked', or None
+    '''
+    sql = '''SELECT reachable, banner, checked FROM reachability
+             WHERE host=?'''
+    c = db.cursor()
+    c.execute(sql, (host_id,))
+    row = c.fetchone()
+    if row is None:
+        return None
+    reachable, banner, checked = row
+    if max_age is not None and time.time() - checked > max_age:
+        return None
+    return {'reachable': bool(reachable), 'banner': banner,
+            'checked': checked}
+
+
+@db_connector
+def db_import_hosts(db, records):
+    '''
+    Upsert hosts, their apps and parent links in a single transaction
+    Hosts in records are made to match them exactly; hosts not in records
+    are left alone.
+    :param db: DB Connector (use db_connector func)
+    :param records: list of dicts with 'name', 'updater', 'apps' list and
+                    'parent' hostname ('' for none), parents already in db
+                    or in records
+    :return: List of formatted strings describing the changes
+    '''
+    hosts_sql = '''SELECT id, name, updater, children FROM hosts'''
+    ids_sql = '''SELECT id, name FROM hosts'''
+    apps_sql = '''SELECT host, function FROM apps ORDER BY id'''
+    insert_sql = '''INSERT INTO hosts(name,updater,children) VALUES(?,?,'0')'''
+    updater_sql = '''UPDATE hosts SET updater = ? WHERE name = ?'''
+    delete_apps_sql = '''DELETE FROM apps WHERE host = ?'''
+    insert_apps_sql = '''INSERT INTO apps(host,function) VALUES(?,?)'''
+    children_sql = '''UPDATE hosts SET children = ? WHERE id = ?'''
+    c = db.cursor()
+    c.execute(hosts_sql)
+    hosts = c.fetchall()
+    updaters = {name: updater for _, name, updater, _ in hosts}
+    new = [record for record in records if record['name'] not in updaters]
+    changed = [record for record in records if record['name'] in updaters
+               and updaters[record['name']] != record['updater']]
+    c.executemany(insert_sql, [(record['name'], record['updater'])
+                               for record in new])
+    c.executemany(updater_sql, [(record['updater'], record['name'])
+                                for record in changed])
+    out = [f'+ {record["name"]}: added, '
+           f'{" ".join([record["updater"]] + record["apps"])}'
+           for record in new]
+    out += [f'~ {record["name"]}: updater {updaters[record["name"]]} -> '
+            f'{record["updater"]}' for record in changed]
+
+    c.execute(ids_sql)
+    ids = {name: host_id for host_id, name in c.fetchall()}
+    c.execute(apps_sql)
+    apps = {}
+    for host_id, function in c.fetchall():
+        apps.setdefault(host_id, []).append(function)
+    replace = [record for record in records
+               if apps.get(ids[record['name']], []) != record['apps']]
+    c.executemany(delete_apps_sql, [(ids[record['name']],)
+                                    for record in replace])
+    c.executemany(insert_apps_sql, [(ids[record['name']], app)
+                                    for record in replace
+                                    for app in record['apps']])
+    for record in replace:
+        if record['name'] in updaters:
+            old = apps.get(ids[record['name']], [])
+            out.append(f'~ {record["name"]}: apps {" ".join(old) or "-"} -> '
+                       f'{" ".join(record["apps"]) or "-"}')
+
+    children = {host_id: split_children(kids) for host_id, _, _, kids in hosts}
+    parents = {child: host_id for host_id, kids in children.items()
+               for child in kids}
+    names = {host_id: name for name, host_id in ids.items()}
+    dirty = set()
+    for record in records:
+        child = ids[record['name']]
+        old = parents.get(child)
+        parent = ids.get(record['parent'])
+        if old == parent:
+            continue
+        if old is not None:
+            children[old].remove(child)
+            dirty.add(old)
+        if parent is not None:
+            children.setdefault(parent, []).append(child)
+            dirty.add(parent)
+        out.append(f'~ {record["name"]}: parent {names.get(old, "-")} -> '
+                   f'{record["parent"] or "-"}')
+    c.executemany(children_sql, [(','.join(map(str, children[host_id])) or '0',
+                                  host_id) for host_id in sorted(dirty)])
+    return out
+
+
 @db_connector
 def db_read_host(db, host_id, config):
     '''
@@ -330,3 +1264,13 @@ def db_read_host(db, host_id, config):
         appList.append(row[0])
     children = db_fetch_children('', host_id)
     return Host(name, updater, appList, config, children)
+
+
+def split_children(children):
+    '''
+    Parse the children column of a hosts row
+    :param children: comma-separated host ids, '0' or None for none
+    :return: list of integer host ids
+    '''
+    return [int(child) for child in str(children or '0').split(',')
+            if child.strip() not in ('', '0')]
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# daemon.py
+
+# Imports
+from backend import SOCKET_PATH, db_create_db, db_fetch_hostid,\
+                    db_fetch_hostlist, db_read_host
+from concurrent.futures import ThreadPoolExecutor
+from naga import get_sudo, run_command, run_updates
+import metrics
+import argparse
+import json
+import os
+import socketserver
+import threading
+
+
+class NagaDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''
+    Resident naga server holding sudo config and warm Host connections
+    :param path: Unix socket to listen on
+    :param config: Configuration object for Connection class
+    :param keepalive: seconds between SSH keepalive packets
+    '''
+    daemon_threads = True
+
+    def __init__(self, path, config, keepalive=30):
+        self.config = config
+        self.keepalive = keepalive
+        self.database = os.path.abspath(os.environ.get('CONN', 'hosts.db'))
+        self.hosts = {}
+        self.locks = {}
+        self.registry_lock = threading.Lock()
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, NagaHandler)
+        os.chmod(path, 0o600)
+
+    def load(self, name):
+        '''
+        Fetch Host from the registry, reading it from db on first use
+        :param name: hostname in db
+        :return: Host object and its lock, or None, None if not in db
+        '''
+        with self.registry_lock:
+            if name not in self.hosts:
+                host_id = db_fetch_hostid('', name)
+                if host_id is None:
+                    return None, None
+                host = db_read_host('', host_id, self.config)
+                host.conn.keepalive = self.keepalive
+                self.hosts[name] = host
+                self.locks[name] = threading.Lock()
+            return self.hosts[name], self.locks[name]
+
+    def close(self, hosts):
+        '''
+        Close connections of dropped Hosts once no request is using them
+        :param hosts: list of (Host, lock) pairs
+        '''
+        for host, lock in hosts:
+            with lock:
+                host.conn.close()
+
+    def warm(self, workers=16):
+        '''
+        Load every host in db and open its connection in the background
+        :param workers: connections to open at once
+        '''
+        def connect(name):
+            host, lock = self.load(name)
+            with lock:
+                try:
+                    host.conn.open()
+                except Exception:
+                    pass
+
+        pool = ThreadPoolExecutor(max_workers=workers)
+        for name in db_fetch_hostlist(''):
+            pool.submit(connect, name)
+        pool.shutdown(wait=False)
+
+    def execute(self, request):
+        '''
+        Run a client request against the loaded hosts
+        :param request: dict with 'command' ('ping', 'reload', 'run' or an
+                        admin function), 'hosts' and optional 'args'
+        :return: response dict with 'output' and 'reboot' lists
+        '''
+        if request.get('database') != self.database:
+            return {'error': f'serving {self.database}'}
+        command = request.get('command', '')
+        if command == 'ping':
+            return {'output': [], 'reboot': []}
+        if command == 'reload':
+            with self.registry_lock:
+                old = [(host, self.locks[name])
+                       for name, host in self.hosts.items()]
+                self.hosts = {}
+                self.locks = {}
+            threading.Thread(target=self.close, args=(old,),
+                             daemon=True).start()
+            return {'output': ['Host registry reloaded.'], 'reboot': []}
+        output = []
+        reboot = []
+        for name in request.get('hosts', []):
+            host, lock = self.load(name)
+            if host is None:
+                output.append(f'{name}: not found')
+                continue
+            with lock:
+                # Give hosts that were down on an earlier request a new try
+                host.conn.breaker = None
+                if command == 'run':
+                    if run_updates(host, output.extend) is True:
+                        reboot.append(name)
+                else:
+                    output.extend(run_command(host, command,
+                                              request.get('args', [])))
+        return {'output': output, 'reboot': reboot}
+
+
+class NagaHandler(socketserver.StreamRequestHandler):
+    '''One JSON request line in, one JSON response line out'''
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            response = self.server.execute(request)
+        except Exception as e:
+            response = {'error': f'{type(e).__name__}: {e}'}
+        self.wfile.write((json.dumps(response) + '\n').encode())
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Resident naga daemon.')
+    parser.add_argument("-db", "--database", type=str, default="hosts.db",
+                        help="SQLite3 db file to use")
+    parser.add_argument("-s", "--socket", type=str, default=SOCKET_PATH,
+                        help="Unix socket to listen on")
+    parser.add_argument("-t", "--timeout", type=int, default=10,
+                        help="SSH connect timeout in seconds (default 10)")
+    parser.add_argument("--persistent", action="store_true",
+                        help="Run commands through one persistent shell per host")
+    parser.add_argument("-m", "--metrics-port", type=int,
+                        help="Serve OpenMetrics telemetry on this local port")
+    parser.add_argument("-k", "--keepalive", type=int, default=30,
+                        help="SSH keepalive interval in seconds (default 30)")
+    args = parser.parse_args()
+    os.environ['CONN'] = args.database
+    db_create_db()
+    config = get_sudo(args.timeout, args.persistent)
+    server = NagaDaemon(args.socket, config, args.keepalive)
+    server.warm()
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    print(f'naga daemon listening on {args.socket}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+        del os.environ['CONN']
+
+
+if __name__ == '__main__':
+    import sys
+    main(sys.argv)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# hostfile.py
+
+# Imports
+from collections import Counter
+from pathlib import Path
+import csv
+import json
+
+try:
+    import yaml
+    PARSE_ERRORS = (OSError, ValueError, csv.Error, yaml.YAMLError)
+except ImportError:
+    yaml = None
+    PARSE_ERRORS = (OSError, ValueError, csv.Error)
+
+
+FIELDS = ('name', 'updater', 'apps', 'parent')
+
+
+class HostFileError(Exception):
+    '''Inventory file could not be read or holds invalid records'''
+
+
+def file_format(path):
+    '''
+    Pick inventory file format from its suffix
+    :param path: Path of inventory file
+    :return: 'csv', 'json' or 'yaml'
+    '''
+    suffix = path.suffix.lower()
+    if suffix in ('.yaml', '.yml'):
+        if yaml is None:
+            raise HostFileError(f'{path}: YAML needs the PyYAML module')
+        return 'yaml'
+    if suffix in ('.csv', '.json'):
+        return suffix[1:]
+    raise HostFileError(f'{path}: use a .csv, .json or .yaml file')
+
+
+def normalize(record, line):
+    '''
+    Turn one raw inventory entry into a host record
+    :param record: dict as read from the file
+    :param line: entry number for error messages
+    :return: dict with 'name', 'updater', 'apps' list and 'parent' name
+    '''
+    if not isinstance(record, dict):
+        raise HostFileError(f'entry {line}: expected a mapping of {FIELDS}')
+    name = str(record.get('name') or '').strip()
+    if not name:
+        raise HostFileError(f'entry {line}: host has no name')
+    apps = record.get('apps') or []
+    if isinstance(apps, str):
+        apps = apps.split()
+    return {'name': name,
+            'updater': str(record.get('updater') or 'apt_all').strip(),
+            'apps': [str(app).strip() for app in apps if str(app).strip()],
+            'parent': str(record.get('parent') or '').strip()}
+
+
+def read_hosts(filename):
+    '''
+    Read declarative host inventory from a CSV, JSON or YAML file
+    CSV files have a header row with name, updater, apps and parent
+    columns; apps are separated by spaces.
+    :param filename: inventory file path
+    :return: list of host record dicts
+    '''
+    path = Path(filename).expanduser()
+    kind = file_format(path)
+    try:
+        with open(path, newline='') as f:
+            if kind == 'csv':
+                entries = list(csv.DictReader(f))
+            elif kind == 'json':
+                entries = json.load(f)
+            else:
+                entries = yaml.safe_load(f)
+    except PARSE_ERRORS as e:
+        raise HostFileError(f'{path}: {e}')
+    if isinstance(entries, dict):
+        entries = entries.get('hosts', [])
+    if not isinstance(entries, list):
+        raise HostFileError(f'{path}: expected a list of hosts')
+    records = [normalize(entry, line)
+               for line, entry in enumerate(entries, 1)]
+    counts = Counter(record['name'] for record in records)
+    duplicates = sorted(name for name, count in counts.items() if count > 1)
+    if duplicates:
+        raise HostFileError(f'{path}: duplicate hosts {", ".join(duplicates)}')
+    return records
+
+
+def write_hosts(filename, records):
+    '''
+    Write host inventory to a CSV, JSON or YAML file
+    :param filename: inventory file path
+    :param records: list of host record dicts
+    '''
+    path = Path(filename).expanduser()
+    kind = file_format(path)
+    with open(path, 'w', newline='') as f:
+        if kind == 'csv':
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            for record in records:
+                writer.writerow(dict(record, apps=' '.join(record['apps'])))
+        elif kind == 'json':
+            json.dump(records, f, indent=2)
+            f.write('\n')
+        else:
+            yaml.safe_dump(records, f, sort_keys=False)
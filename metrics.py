@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# metrics.py
+
+# Imports
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import threading
+
+
+METRICS = {
+    'naga_run_duration_seconds': ('gauge', 'Wall time of the last run'),
+    'naga_run_timestamp_seconds': ('gauge', 'Unix time the last run ended'),
+    'naga_host_duration_seconds': ('gauge', 'Wall time of last host run'),
+    'naga_phase_duration_seconds': ('gauge', 'Wall time of last host phase'),
+    'naga_phase_failures': ('counter', 'Host phases reporting a failure'),
+    'naga_ssh_connect_seconds': ('gauge', 'Latency of last SSH connect'),
+    'naga_packages_pending': ('gauge', 'Packages with updates available'),
+    'naga_packages_upgraded': ('gauge', 'Packages upgraded by last run'),
+    'naga_reboot_required': ('gauge', 'Host needs a reboot (1) or not (0)'),
+}
+
+
+class Registry:
+    '''
+    Thread-safe in-memory store of run samples, rendered as OpenMetrics
+    Recording a sample is a dict update under a lock, so it can be done
+    inline in the run without slowing it down.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def set(self, name, value, **labels):
+        '''
+        Set gauge sample
+        :param name: metric name from METRICS
+        :param value: numeric value
+        :param labels: label names and values
+        '''
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.samples[key] = value
+
+    def inc(self, name, value=1, **labels):
+        '''
+        Increment counter sample
+        :param name: metric name from METRICS
+        :param value: amount to add
+        :param labels: label names and values
+        '''
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.samples[key] = self.samples.get(key, 0) + value
+
+    def render(self):
+        '''
+        Format all samples in OpenMetrics text exposition format
+        :return: string ending in # EOF
+        '''
+        with self.lock:
+            samples = sorted(self.samples.items())
+        out = []
+        for name, (kind, help) in METRICS.items():
+            lines = [sample_line(name, kind, labels, value)
+                     for (metric, labels), value in samples
+                     if metric == name]
+            if lines:
+                out.append(f'# TYPE {name} {kind}')
+                out.append(f'# HELP {name} {help}')
+                out.extend(lines)
+        out.append('# EOF')
+        return '\n'.join(out) + '\n'
+
+    def write(self, path):
+        '''
+        Write rendered samples to a textfile, atomically replacing it
+        :param path: destination file (e.g. for node_exporter's collector)
+        '''
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    '''Serve the registry on any GET'''
+
+    def do_GET(self):
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/openmetrics-text; '
+                         'version=1.0.0; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def sample_line(name, kind, labels, value):
+    '''
+    Format one OpenMetrics sample line
+    :param name: metric family name
+    :param kind: 'gauge' or 'counter' (counters get the _total suffix)
+    :param labels: tuple of (name, value) label pairs
+    :param value: numeric value
+    :return: formatted string
+    '''
+    if kind == 'counter':
+        name = f'{name}_total'
+    if labels:
+        pairs = ','.join(f'{key}="{escape(str(val))}"' for key, val in labels)
+        name = f'{name}{{{pairs}}}'
+    value = float(value)
+    if value.is_integer():
+        return f'{name} {int(value)}'
+    return f'{name} {value!r}'
+
+
+def escape(value):
+    '''
+    Escape an OpenMetrics label value
+    :param value: label value string
+    :return: escaped string
+    '''
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def serve(port, address='127.0.0.1'):
+    '''
+    Serve REGISTRY over HTTP from a background thread
+    :param port: TCP port to listen on
+    :param address: interface to bind, localhost by default
+    :return: ThreadingHTTPServer instance
+    '''
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+REGISTRY = Registry()
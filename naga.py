@@ -10,12 +10,60 @@ from backend import Host, db_add_app, db_add_host, db_fetch_hostid, db_add_child
                     db_fetch_hostid, db_read_host, db_connector,\
                     db_fetch_hostlist, db_fetch_children, db_delete_host,\
                     db_fetch_parent_id, db_fetch_hostname, db_delete_child,\
-                    db_delete_app, db_fetch_apps
+                    db_delete_app, db_fetch_apps, db_create_db,\
+                    db_add_plan, db_fetch_plan, db_add_inventory,\
+                    db_fetch_inventory_digest, db_fetch_packages,\
+                    db_add_reachability, db_fetch_reachability, probe_hosts,\
+                    daemon_request, db_add_job, db_add_checkpoint,\
+                    db_fetch_job, db_finish_job, db_add_history,\
+                    db_fetch_history, db_fetch_phases, db_add_prefetch,\
+                    db_fetch_staged, db_export_hosts, db_import_hosts,\
+                    SSH_CONFIG
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait,\
+                               FIRST_COMPLETED
+from metrics import REGISTRY
+from report import Summarizer
 import admin
 import argparse
+import hostfile
+import heapq
+import inspect
 import math
 import os
 import re
+import threading
+import time
+
+
+class ShellJob:
+    '''
+    Background shell command with its own output buffer
+    :param id: job number
+    :param command: command line as typed
+    '''
+    def __init__(self, id, command):
+        self.id = id
+        self.command = command
+        self.output = []
+        self.cancel = threading.Event()
+        self.future = None
+        self.reported = False
+
+    def emit(self, out):
+        self.output.extend(out)
+
+    def status(self):
+        if self.future.cancelled():
+            return 'cancelled'
+        if not self.future.done():
+            if self.cancel.is_set():
+                return 'cancelling'
+            return 'running' if self.future.running() else 'queued'
+        if self.future.exception() is not None:
+            return 'failed'
+        return 'cancelled' if getattr(self.cancel, 'skipped', False) \
+            else 'done'
+
 
 class NagaPrompt(Cmd):
     intro = 'Welcome to the Naga shell. Type help or ? to list commands.\n'
@@ -23,6 +71,8 @@ class NagaPrompt(Cmd):
     reboot_list = []
     hosts = {}
     config = None
+    jobs = {}
+    pool = None
 
 
     def do_add_app(self, inp):
@@ -30,6 +80,7 @@ class NagaPrompt(Cmd):
         id = pick_host(inp, 'Host for new app? ')
         app = str(input("New app function? ")).lower()
         db_add_app('', id, app)
+        daemon_request({'command': 'reload', 'hosts': []})
         self.do_load(db_fetch_hostname('', id))
 
 
@@ -45,6 +96,7 @@ class NagaPrompt(Cmd):
             if parent:
                 db_delete_child('', parent, id)
             db_delete_host('', id)
+            daemon_request({'command': 'reload', 'hosts': []})
             print("Deleted. Defined hosts:")
             print_out(print_cols(db_fetch_hostlist('')))
         else:
@@ -60,12 +112,18 @@ class NagaPrompt(Cmd):
         print_out(print_cols(apps))
         app = str(input(f'App to remove? ')).lower()
         db_delete_app('', id, app)
+        daemon_request({'command': 'reload', 'hosts': []})
         print('Done.')
         self.do_load(hostname)
 
 
     def do_exit(self, inp):
         '''Exit to system shell. Shorthand: x q'''
+        running = [job for job in self.jobs.values()
+                   if not job.future.done()]
+        if running:
+            print(f'Waiting for {len(running)} background jobs...')
+            self.do_wait('')
         if len(self.reboot_list) > 0:
             print(f'\n\nThe following hosts need to be rebooted:')
             print_out(self.reboot_list)
@@ -73,6 +131,13 @@ class NagaPrompt(Cmd):
         return True
 
 
+    def do_export(self, inp):
+        '''Write all hosts to inventory file: export <file.csv|json|yaml>'''
+        if inp == '':
+            inp = input("Export to which file? ")
+        print_out(export_hosts(inp))
+
+
     def do_fetch_parent(self, inp):
         '''Fetch id of host parent from database'''
         id = pick_host(inp, "Find parent of: ")
@@ -84,6 +149,29 @@ class NagaPrompt(Cmd):
             print(f'{inp} is a child of {parent}')
 
 
+    def do_import(self, inp):
+        '''Upsert hosts from inventory file: import <file.csv|json|yaml>'''
+        if inp == '':
+            inp = input("Import which file? ")
+        print_out(import_hosts(inp))
+        for name in set(self.hosts) & set(db_fetch_hostlist('')):
+            self.hosts[name] = db_read_host('', db_fetch_hostid('', name),
+                                            self.config)
+
+
+    def do_inventory(self, inp):
+        '''Refresh package inventory of specified hosts - \'all\' for all'''
+        if self.config is None:
+            self.config = get_sudo()
+        if inp == 'all':
+            hosts = db_fetch_hostlist('')
+        else:
+            hosts = [db_fetch_hostname('', pick_host(host, 'Which host? '))
+                     for host in str(inp).split(',')]
+        for out in fleet_map(inventory_host, hosts, self.config):
+            print_out(out)
+
+
     def do_list(self, inp):
         '''List configured hosts in database'''
         print(f'Defined hosts:')
@@ -112,10 +200,18 @@ class NagaPrompt(Cmd):
             self.config = get_sudo()
         host = add_host(self.config)
         self.hosts[host.name] = host
+        daemon_request({'command': 'reload', 'hosts': []})
         print("Loaded hosts:")
         print_out(print_cols((list(self.hosts.keys()))))
 
 
+    def do_package(self, inp):
+        '''Show hosts with package installed, from stored inventories'''
+        if inp == '':
+            inp = input("Package name (wildcards allowed)? ")
+        print_out(package_query(inp))
+
+
     def do_reboot(self, inp):
         '''Reboot specified hosts'''
         id = pick_host(inp, "Reboot which host? ")
@@ -132,12 +228,177 @@ class NagaPrompt(Cmd):
         print_out(admin.reboot(self.hosts[hostname], time=time, halt=flag))
 
 
+    def do_cancel(self, inp):
+        '''Cancel background job: cancel <id>'''
+        job = self.pick_job(inp)
+        if job is None:
+            return
+        if job.future.cancel():
+            print(f'[{job.id}] cancelled before it started')
+        elif job.command.split()[0] == 'cmd' and not job.future.done():
+            print(f'[{job.id}] a running cmd job cannot be stopped')
+        elif not job.future.done():
+            job.cancel.set()
+            print(f'[{job.id}] cancelling after the current phase')
+
+
+    def do_cmd(self, inp):
+        '''Run admin function on host: cmd <host> <function> [args]'''
+        target = self.cmd_target(inp)
+        if target is not None:
+            self.cmd_job(*target, print_out)
+
+
+    def do_fg(self, inp):
+        '''Show output of background job until it finishes: fg <id>'''
+        job = self.pick_job(inp)
+        if job is None:
+            return
+        shown = 0
+        try:
+            while True:
+                done = wait([job.future], timeout=0.2).done
+                lines = job.output[shown:]
+                shown += len(lines)
+                print_out(lines)
+                if done:
+                    break
+        except KeyboardInterrupt:
+            print(f'\n[{job.id}] still running in the background')
+            return
+        job.reported = True
+        print(f'[{job.id}] {job.status()}  {job.command}')
+
+
+    def do_jobs(self, inp):
+        '''List background jobs'''
+        for job in self.jobs.values():
+            print(f'[{job.id}] {job.status():<10} {len(job.output):>5} lines'
+                  f'  {job.command}')
+
+
     def do_run(self, inp):
         '''Run update process for specified host'''
+        id = pick_host(inp, "Run updates for which host?")
+        hostname = db_fetch_hostname('', id)
+        if self.run_job(id, hostname, print_out) is not None:
+            self.reboot_list.append(f'\t{hostname}')
+
+
+    def do_wait(self, inp):
+        '''Wait for background jobs to finish: wait [id]'''
+        if inp:
+            job = self.pick_job(inp)
+            jobs = [job] if job is not None else []
+        else:
+            jobs = list(self.jobs.values())
+        wait([job.future for job in jobs])
+
+
+    def background(self, line):
+        '''Start a run or cmd line as a job on the shared worker pool'''
+        command, _, inp = line.partition(' ')
+        if command == 'run':
+            id = pick_host(inp, "Run updates for which host?")
+            hostname = db_fetch_hostname('', id)
+            args = (id, hostname)
+            func = self.run_job
+        elif command == 'cmd':
+            args = self.cmd_target(inp)
+            func = self.cmd_job
+            if args is None:
+                return
+        else:
+            print(f'{command}: only run and cmd can run in the background')
+            return
+        # Password prompt and host loading must happen here, not in a worker,
+        # even with a daemon running: it may be gone by the time the job runs
         if self.config is None:
             self.config = get_sudo()
-        id = pick_host(inp, "Run updates for which host?")
-        run_host(id, self.config)
+        if command == 'cmd' and args[0] not in self.hosts:
+            self.do_load(args[0])
+        if NagaPrompt.pool is None:
+            NagaPrompt.pool = ThreadPoolExecutor(max_workers=8)
+        job = ShellJob(len(self.jobs) + 1, line)
+        job.future = self.pool.submit(func, *args, job.emit, job.cancel)
+        job.future.add_done_callback(self.merge_reboot)
+        self.jobs[job.id] = job
+        print(f'[{job.id}] started  {line}')
+
+
+    def cmd_job(self, hostname, words, emit, cancel=None):
+        '''Run admin function on a loaded host, via the daemon if present'''
+        response = daemon_request({'command': words[0], 'args': words[1:],
+                                   'hosts': [hostname]})
+        if response is not None:
+            emit(response['output'])
+            return
+        if cancel is not None and cancel.is_set():
+            cancel.skipped = True
+            emit([f'{hostname}: {words[0]} skipped, cancelled'])
+            return
+        if hostname not in self.hosts:
+            self.do_load(hostname)
+        host = self.hosts[hostname]
+        # Give a host that was down on an earlier command a new try
+        host.conn.breaker = None
+        emit(run_command(host, words[0], words[1:]))
+
+
+    def cmd_target(self, inp):
+        '''Parse cmd arguments into hostname and function words'''
+        words = str(inp).split()
+        if len(words) < 2:
+            print('Usage: cmd <host> <function> [args]')
+            return None
+        hostname = db_fetch_hostname('', pick_host(words[0], 'Which host? '))
+        return hostname, words[1:]
+
+
+    def merge_reboot(self, future):
+        '''Add host of a finished background run to the reboot list'''
+        if not future.cancelled() and future.exception() is None and \
+                future.result():
+            self.reboot_list.append(f'\t{future.result()}')
+
+
+    def pick_job(self, inp):
+        '''Find background job by id'''
+        try:
+            return self.jobs[int(inp)]
+        except (KeyError, ValueError):
+            print(f'No such job: {inp}')
+            return None
+
+
+    def run_job(self, id, hostname, emit, cancel=None):
+        '''
+        Run updates for host, via the daemon if present
+        :return: hostname if it needs a reboot, else None
+        '''
+        response = daemon_request({'command': 'run', 'hosts': [hostname]})
+        if response is not None:
+            emit(response['output'])
+            flag = hostname in response['reboot']
+        else:
+            if self.config is None:
+                self.config = get_sudo()
+            flag = run_host(id, self.config, emit, cancel=cancel)
+        return hostname if flag is True else None
+
+
+    def onecmd(self, line):
+        if line.strip().endswith('&'):
+            return self.background(line.strip()[:-1].strip())
+        return super().onecmd(line)
+
+
+    def postcmd(self, stop, line):
+        for job in self.jobs.values():
+            if job.future.done() and not job.reported:
+                job.reported = True
+                print(f'[{job.id}] {job.status()}  {job.command}')
+        return stop
 
 
     def default(self, inp):
@@ -176,13 +437,18 @@ def add_host(config=None):
     return host
 
 
-def get_sudo():
+def get_sudo(connect_timeout=10, persistent=False):
     '''
     Create Config object with sudo password
+    :param connect_timeout: seconds to wait for each SSH connection
+    :param persistent: run commands through one persistent shell per host
     :return: Fabric/Config object
     '''
     return Config(overrides={'sudo': {'password':
-                             getpass("What's your sudo password? ")}})
+                             getpass("What's your sudo password? ")},
+                             'timeouts': {'connect': connect_timeout},
+                             'naga': {'persistent': persistent}},
+                  ssh_config=SSH_CONFIG)
 
 
 def pick_host(inp, query):
@@ -199,6 +465,251 @@ def pick_host(inp, query):
     return db_fetch_hostid('', str(inp).lower())
 
 
+PHASE_ESTIMATES = {'apt_all': 300, 'brew_all': 900, 'git_all': 120}
+
+
+def estimate_runtime(hostname):
+    '''
+    Estimate how long an update run of host takes, from past durations
+    Phases without history use PHASE_ESTIMATES, or 60 seconds. Phases that
+    run at the same time count once, so this is the longest chain of
+    phases that have to wait for each other.
+    :param hostname: hostname in db
+    :return: estimated seconds
+    '''
+    phases = db_fetch_phases('', db_fetch_hostid('', hostname))
+    finish = []
+    for phase, after in zip(phases, phase_order(phases)):
+        history = sorted(db_fetch_history('', hostname, phase, 10))
+        if history:
+            seconds = history[len(history) // 2]
+        else:
+            seconds = PHASE_ESTIMATES.get(phase, 60)
+        finish.append(seconds + max((finish[i] for i in after), default=0))
+    return max(finish, default=0)
+
+
+def longest_first(hosts, workers=8):
+    '''
+    Order hosts longest estimated run first, so slow hosts don't start last
+    :param hosts: list of hostnames
+    :param workers: number of hosts run at once
+    :return: list of hostnames, estimated makespan in seconds
+    '''
+    estimates = {host: estimate_runtime(host) for host in hosts}
+    ordered = sorted(hosts, key=lambda host: -estimates[host])
+    finish = [0] * min(workers, len(hosts))
+    for host in ordered:
+        heapq.heapreplace(finish, finish[0] + estimates[host])
+    return ordered, max(finish, default=0)
+
+
+def fleet_map(func, hosts, config, workers=8):
+    '''
+    Run func(host_id, config) concurrently across hosts
+    :param func: per-host function taking host_id and config; it reports
+                 its own failures, so one host can't abort the others
+    :param hosts: list of hostnames
+    :param config: Connection Configuration object
+    :param workers: maximum number of hosts to process at once
+    :return: generator of func results, in order of completion
+    '''
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        jobs = [pool.submit(func, db_fetch_hostid('', host), config)
+                for host in hosts]
+        for job in as_completed(jobs):
+            yield job.result()
+
+
+def command_host(host_id, config, command, args=()):
+    '''
+    Execute a named admin.py function against host from db
+    :param host_id: host_id from db
+    :param config: Connection Configuration object
+    :param command: bare admin.py function name
+    :param args: additional string arguments for the function
+    :return: List of formatted strings
+    '''
+    host = db_read_host('', host_id, config)
+    try:
+        return run_command(host, command, args)
+    except Exception as e:
+        return [f'{host.name}: {command} failed: {type(e).__name__}: {e}']
+
+
+def export_hosts(filename):
+    '''
+    Write every host in db to a CSV, JSON or YAML inventory file
+    :param filename: inventory file path
+    :return: List of formatted strings
+    '''
+    records = db_export_hosts('')
+    try:
+        hostfile.write_hosts(filename, records)
+    except (hostfile.HostFileError, OSError) as e:
+        return [f'Export failed: {e}']
+    return [f'Exported {len(records)} hosts to {filename}']
+
+
+def import_hosts(filename):
+    '''
+    Upsert hosts, apps and parent links from an inventory file in one
+    transaction; nothing is written if any entry is invalid
+    :param filename: CSV, JSON or YAML inventory file path
+    :return: List of formatted strings describing the changes
+    '''
+    try:
+        records = hostfile.read_hosts(filename)
+    except hostfile.HostFileError as e:
+        return [f'Import failed: {e}']
+    known = set(db_fetch_hostlist('')) | {record['name'] for record in records}
+    errors = []
+    for record in records:
+        for function in [record['updater']] + record['apps']:
+            if not inspect.isfunction(getattr(admin, function, None)):
+                errors.append(f'{record["name"]}: no admin function {function}')
+        if record['parent'] and record['parent'] not in known:
+            errors.append(f'{record["name"]}: unknown parent '
+                          f'{record["parent"]}')
+    if errors:
+        return ['Import failed, nothing written:'] + errors
+    out = db_import_hosts('', records)
+    if not out:
+        return [f'{filename}: {len(records)} hosts, no changes']
+    daemon_request({'command': 'reload', 'hosts': []})
+    return out + [f'{filename}: {len(records)} hosts, {len(out)} changes']
+
+
+def inventory_host(host_id, config=None):
+    '''
+    Refresh stored package inventory for host if it changed remotely
+    :param host_id: host_id from db
+    :param config: Connection Configuration object
+    :return: List of formatted strings
+    '''
+    host = db_read_host('', host_id, config)
+    try:
+        known = db_fetch_inventory_digest('', host_id)
+        out, digest, packages = admin.pkg_inventory(host, known)
+        if packages is not None:
+            db_add_inventory('', host_id, digest, packages)
+    except Exception as e:
+        return [f'{host.name}: inventory failed: {type(e).__name__}: {e}']
+    return out
+
+
+def package_query(pattern):
+    '''
+    Look up installed package versions across the fleet from the db
+    :param pattern: package name, shell-style wildcards (*, ?) allowed
+    :return: List of formatted strings
+    '''
+    rows = db_fetch_packages('', pattern)
+    if not rows:
+        return [f'{pattern}: not installed on any inventoried host']
+    return [f'{host}: {name} {version}' for host, name, version in rows]
+
+
+def plan_host(host_id, config=None):
+    '''
+    Execute read-only half of host updater, cache resulting plan in db
+    :param host_id: host_id from db
+    :param config: Connection Configuration object
+    :return: hostname, list of formatted strings, plan dict or None
+    '''
+    host = db_read_host('', host_id, config)
+    plan_func = getattr(admin, host.updater.replace('_all', '_plan'), None)
+    if plan_func is None:
+        return host.name, [f'{host.name}: no planner for {host.updater}'], None
+    try:
+        out, plan = plan_func(host)
+        if plan['pending'] is not None:
+            db_add_plan('', host_id, plan)
+            REGISTRY.set('naga_packages_pending', plan['pending'],
+                         host=host.name)
+            REGISTRY.set('naga_reboot_required', int(plan['reboot']),
+                         host=host.name)
+    except Exception as e:
+        return host.name, [f'{host.name}: plan failed: '
+                           f'{type(e).__name__}: {e}'], None
+    return host.name, out, plan
+
+
+def plan_table(plans):
+    '''
+    Format fleet plan results as a table of pending updates
+    :param plans: dict of hostname: plan dict (or None on failure)
+    :return: List of formatted strings
+    '''
+    out = ['host'.rjust(20, ' ') + 'pending'.rjust(10, ' ') +
+           'security'.rjust(10, ' ') + 'reboot'.rjust(10, ' ')]
+    totals = [0, 0, 0]
+    for name in sorted(plans):
+        plan = plans[name]
+        if plan is None or plan['pending'] is None:
+            out.append(name.rjust(20, ' ') + 'failed'.rjust(10, ' '))
+            continue
+        reboot = 'yes' if plan['reboot'] else ''
+        out.append(name.rjust(20, ' ') + str(plan['pending']).rjust(10, ' ') +
+                   str(plan['security']).rjust(10, ' ') +
+                   reboot.rjust(10, ' '))
+        totals[0] += plan['pending']
+        totals[1] += plan['security']
+        totals[2] += int(plan['reboot'])
+    out.append('total'.rjust(20, ' ') + str(totals[0]).rjust(10, ' ') +
+               str(totals[1]).rjust(10, ' ') + str(totals[2]).rjust(10, ' '))
+    return out
+
+
+def preflight(hosts, config, max_age=300):
+    '''
+    Drop hosts not answering on their SSH port, probing concurrently
+    :param hosts: list of hostnames
+    :param config: Connection Configuration object
+    :param max_age: seconds a cached probe result is reused without probing
+    :return: list of reachable hostnames, in original order
+    '''
+    reachable = set()
+    targets = []
+    for name in hosts:
+        host_id = db_fetch_hostid('', name)
+        cached = db_fetch_reachability('', host_id, max_age)
+        if cached is None:
+            targets.append(db_read_host('', host_id, config))
+        elif cached['reachable']:
+            reachable.add(name)
+    for name, banner in probe_hosts(targets).items():
+        db_add_reachability('', db_fetch_hostid('', name), banner)
+        if banner is not None:
+            reachable.add(name)
+    dropped = [name for name in hosts if name not in reachable]
+    if dropped:
+        print('Unreachable, skipping:')
+        print_out(print_cols(dropped))
+    return [name for name in hosts if name in reachable]
+
+
+def prefetch_host(host_id, config=None):
+    '''
+    Download host's pending upgrades ahead of the run, record if staged
+    :param host_id: host_id from db
+    :param config: Connection Configuration object
+    :return: hostname, list of formatted strings, True if staged
+    '''
+    host = db_read_host('', host_id, config)
+    func = getattr(admin, host.updater.replace('_all', '_prefetch'), None)
+    if func is None:
+        return host.name, [f'{host.name}: no prefetch for {host.updater}'], \
+            False
+    try:
+        out, staged = func(host)
+        db_add_prefetch('', host_id, staged)
+    except Exception as e:
+        return host.name, [f'{host.name}: prefetch failed: '
+                           f'{type(e).__name__}: {e}'], False
+    return host.name, out, staged
+
+
 def print_cols(list):
     '''
     Create a list of four 20-character column stringsfrom input strings
@@ -229,25 +740,381 @@ def print_out(list):
         print(line)
 
 
-def run_host(host_id, config=None):
+def run_command(host, command, args=()):
+    '''
+    Execute a named admin.py function against host
+    :param host: Host object
+    :param command: bare admin.py function name
+    :param args: additional string arguments for the function
+    :return: List of formatted strings
+    '''
+    func = getattr(admin, command, None)
+    if command.startswith('_') or not inspect.isfunction(func):
+        return [f'{command}: no such admin function']
+    if 'conn' in inspect.signature(func).parameters:
+        out = func(host.conn, *args)
+    else:
+        out = func(host, *args)
+    if isinstance(out, tuple):
+        out = out[0]
+    if not isinstance(out, list):
+        out = [f'{host.name}: {out}']
+    return out
+
+
+def phase_failed(out):
+    '''
+    Decide whether admin function output reports a failure
+    :param out: List of formatted strings (or a single string)
+    :return: True if any line reports a failure
+    '''
+    if isinstance(out, str):
+        out = [out]
+    return any(re.search('failed|UnexpectedExit|command failure|timed out',
+                         str(line)) for line in out)
+
+
+def phase_timeout(hostname, phase, multiplier=3, floor=300, default=3600):
+    '''
+    Command timeout for a host phase, learned from its past durations
+    :param hostname: hostname the phase runs on
+    :param phase: bare function name of the phase
+    :param multiplier: headroom over the p99 duration
+    :param floor: minimum timeout in seconds
+    :param default: timeout while there are fewer than 5 past runs
+    :return: timeout in seconds
+    '''
+    history = sorted(db_fetch_history('', hostname, phase))
+    if len(history) < 5:
+        return default
+    p99 = history[math.ceil(0.99 * len(history)) - 1]
+    return max(floor, p99 * multiplier)
+
+
+def run_fleet(hosts, config, job, skip_clean=False, plan_age=720, workers=8,
+              canary=0, growth=2, threshold=0.9, summary=None, deadline=None):
+    '''
+    Run updates across hosts in waves, checkpointing each phase in db
+    With canary > 0, hosts run in a canary batch of that size and then in
+    batches growing by growth; each wave starts only if the previous one
+    reached the success threshold. Hosts within a wave run concurrently.
+    The job is marked finished only once every one of its hosts ran with
+    no failed phase.
+    :param hosts: list of hostnames to run this pass
+    :param config: Connection Configuration object
+    :param job: job dict from db_fetch_job (completed phases are skipped)
+    :param skip_clean: skip the updater of hosts whose cached plan has
+                       nothing pending (their apps still run)
+    :param plan_age: minutes a cached plan or prefetch stays valid
+    :param workers: maximum number of hosts to run at once
+    :param canary: size of the first wave, 0 to run all hosts in one wave
+    :param growth: factor each following wave grows by
+    :param threshold: fraction of a wave's hosts that must succeed
+    :param summary: Summarizer to feed host output to instead of printing
+    :param deadline: Unix time after which no further phases are started
+    :return: list of hostnames needing a reboot, including earlier passes
+    '''
+    reboot_list = list(job['reboot'])
+    complete = True
+    lock = threading.Lock()
+
+    def emit(out):
+        with lock:
+            print_out(out)
+
+    def fleet_host(host):
+        host_id = db_fetch_hostid('', host)
+        if summary is None:
+            host_emit = emit
+        else:
+            def host_emit(out):
+                summary.feed(host, out)
+        skip = set(job['done'].get(host, ()))
+        clean_reboot = False
+        if skip_clean:
+            # The plan only covers the package updater; apps still run
+            updater = db_fetch_phases('', host_id)[0]
+            plan = db_fetch_plan('', host_id, plan_age * 60)
+            if updater not in skip and plan is not None and \
+                    plan['pending'] == 0:
+                host_emit([f'{host}: {updater} nothing pending, skipping'])
+                db_add_checkpoint('', job['id'], host, updater, 'skipped',
+                                  plan['reboot'])
+                skip.add(updater)
+                clean_reboot = plan['reboot'] is True
+        failed = []
+
+        def checkpoint(phase, status, reboot=False):
+            db_add_checkpoint('', job['id'], host, phase, status, reboot)
+            if status not in ('done', 'skipped'):
+                failed.append(phase)
+
+        staged = db_fetch_staged('', host_id, plan_age * 60)
+        flag = run_host(host_id, config, host_emit, skip, checkpoint,
+                        deadline, staged)
+        if staged and not failed:
+            db_add_prefetch('', host_id, False)
+        return flag is True or clean_reboot, not failed
+
+    batches = list(waves(hosts, canary, growth))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for number, wave in enumerate(batches, 1):
+            wave, makespan = longest_first(wave, workers)
+            if len(batches) > 1:
+                emit([f'\nWave {number}/{len(batches)}: {len(wave)} hosts, '
+                      f'about {makespan / 60:.0f} min'])
+            else:
+                emit([f'Estimated run time: about {makespan / 60:.0f} min'])
+            succeeded = 0
+            for host, (flag, ok) in zip(wave, pool.map(fleet_host, wave)):
+                succeeded += int(ok)
+                complete = complete and ok
+                if flag is True and host not in reboot_list:
+                    reboot_list.append(host)
+            if number < len(batches) and succeeded < threshold * len(wave):
+                emit([f'\nWave {number}: {succeeded}/{len(wave)} hosts '
+                      f'succeeded, below {threshold:.0%} - halting run. '
+                      f'Use --resume to continue.'])
+                return reboot_list
+    # Hosts dropped by preflight, or with failed phases, are left for --resume
+    dropped = (set(job['hosts']) & set(db_fetch_hostlist(''))) - set(hosts)
+    if complete and not dropped:
+        db_finish_job('', job['id'])
+    elif dropped:
+        emit([f'\n{len(dropped)} hosts were not reached; use --resume to '
+              f'run them later.'])
+    return reboot_list
+
+
+def run_host(host_id, config=None, emit=print_out, skip=(), checkpoint=None,
+             deadline=None, staged=False, cancel=None):
     '''
     Execute updater, host appList updaters, print output
-    :param db_conn: db connection object
     :param host_id: host_id from db
     :param config: Connection Configuration object
+    :param emit: output function taking a list of formatted strings
+    :param skip: phases (function names) already completed, not to re-run
+    :param checkpoint: called as checkpoint(phase, status, reboot) after
+                       each phase
+    :param deadline: Unix time after which no further phases are started
+    :param staged: upgrades were prefetched, updater should only install
+    :param cancel: threading.Event; once set, no further phases are started
+    :return: True if host needs a reboot
     '''
     host = db_read_host('', host_id, config)
-    host_func = getattr(admin, host.updater, admin.version_check)
-    host_out, flag = host_func(host)
-    print_out(host_out)
-    for app in host.appList:
-        app_func = getattr(admin, app, admin.version_check)
-        print_out(app_func(host))
+    host.staged = staged
+    return run_updates(host, emit, skip, checkpoint, deadline, cancel)
+
+
+def run_updates(host, emit=print_out, skip=(), checkpoint=None,
+                deadline=None, cancel=None):
+    '''
+    Execute updater, host appList updaters on a loaded Host, print output
+    Phases that do not conflict (see admin.conflicts) run at the same time
+    over their own channels; conflicting ones keep their appList order.
+    Each phase's commands time out after a limit learned from its history
+    (see phase_timeout), cut short so none runs past the deadline if one
+    is given.
+    :param host: Host object
+    :param emit: output function taking a list of formatted strings
+    :param skip: phases (function names) already completed, not to re-run
+    :param checkpoint: called as checkpoint(phase, status, reboot) after
+                       each phase
+    :param deadline: Unix time after which no further phases are started
+    :param cancel: threading.Event; once set, no further phases are started
+    :return: True if host needs a reboot
+    '''
+    started = time.time()
+    phases = [host.updater] + host.appList
+    after = phase_order(phases)
+    finished = set()
+    running = {}
+    flag = False
+    with ThreadPoolExecutor(max_workers=len(phases)) as pool:
+        while len(finished) < len(phases):
+            for index in range(len(phases)):
+                if index not in finished and index not in running.values() \
+                        and after[index] <= finished:
+                    future = pool.submit(run_phase, host, phases[index],
+                                         emit, skip, checkpoint, deadline,
+                                         cancel)
+                    running[future] = index
+            done = wait(running, return_when=FIRST_COMPLETED).done
+            for future in done:
+                finished.add(running.pop(future))
+                flag = future.result() or flag
+    REGISTRY.set('naga_host_duration_seconds', time.time() - started,
+                 host=host.name)
+    if host.conn.connect_seconds is not None:
+        REGISTRY.set('naga_ssh_connect_seconds', host.conn.connect_seconds,
+                     host=host.name)
     return flag
 
 
-def setup():
-    config = get_sudo()
+def phase_order(phases):
+    '''
+    Find which earlier phases each phase has to wait for
+    :param phases: list of admin function names, in run order
+    :return: list of sets of indexes into phases
+    '''
+    needs = [getattr(getattr(admin, phase, admin.version_check),
+                     'conflicts', None) for phase in phases]
+    return [{earlier for earlier in range(index)
+             if needs[index] is None or needs[earlier] is None or
+             needs[index] & needs[earlier]}
+            for index in range(len(phases))]
+
+
+def run_phase(host, phase, emit=print_out, skip=(), checkpoint=None,
+              deadline=None, cancel=None):
+    '''
+    Execute one updater or app function on a loaded Host, record outcome
+    :param host: Host object
+    :param phase: admin function name
+    :param emit: output function taking a list of formatted strings
+    :param skip: phases (function names) already completed, not to re-run
+    :param checkpoint: called as checkpoint(phase, status, reboot) after
+                       the phase
+    :param deadline: Unix time after which the phase is not started
+    :param cancel: threading.Event; once set, the phase is not started
+                   and cancel.skipped is set to True
+    :return: True if host needs a reboot
+    '''
+    if cancel is not None and cancel.is_set():
+        cancel.skipped = True
+        emit([f'{host.name}: {phase} skipped, cancelled'])
+        return False
+    if phase in skip:
+        emit([f'{host.name}: {phase} already done'])
+        return False
+    if host.conn.breaker is not None:
+        emit([f'{host.name}: {phase} skipped, host unreachable'])
+        REGISTRY.inc('naga_phase_failures', host=host.name, phase=phase)
+        if checkpoint is not None:
+            checkpoint(phase, 'unreachable')
+        return False
+    if deadline is not None and deadline <= time.time():
+        emit([f'{host.name}: {phase} skipped, run deadline reached'])
+        if checkpoint is not None:
+            checkpoint(phase, 'deadline')
+        return False
+    host.conn.command_timeout = phase_timeout(host.name, phase)
+    host.conn.command_deadline = deadline
+    func = getattr(admin, phase, admin.version_check)
+    reboot = False
+    timed_out = False
+    phase_start = time.time()
+    try:
+        if phase == host.updater:
+            out, reboot = func(host)
+        else:
+            out = func(host)
+    except exceptions.CommandTimedOut as e:
+        out = [f'{host.name}: {phase} timed out after {e.timeout:.0f}s']
+        timed_out = True
+    except Exception as e:
+        out = [f'{host.name}: {phase} failed: {type(e).__name__}: {e}']
+    finally:
+        host.conn.command_timeout = None
+        host.conn.command_deadline = None
+    seconds = time.time() - phase_start
+    REGISTRY.set('naga_phase_duration_seconds', seconds,
+                 host=host.name, phase=phase)
+    emit(out)
+    if timed_out:
+        status = 'timeout'
+    elif phase_failed(out):
+        status = 'failed'
+    else:
+        status = 'done'
+        db_add_history('', host.name, phase, seconds)
+    if status != 'done':
+        REGISTRY.inc('naga_phase_failures', host=host.name, phase=phase)
+    if phase == host.updater:
+        record_updater(host.name, out, reboot is True, status == 'done')
+    if checkpoint is not None:
+        checkpoint(phase, status, reboot is True)
+    return reboot is True
+
+
+def record_updater(hostname, out, reboot, succeeded):
+    '''
+    Record package counts and reboot flag from updater output as metrics
+    :param hostname: name of host the updater ran on
+    :param out: updater output, List of formatted strings
+    :param reboot: True if the host needs a reboot
+    :param succeeded: True if the updater reported no failures
+    '''
+    REGISTRY.set('naga_reboot_required', int(reboot), host=hostname)
+    for line in out:
+        count = re.search(': ([0-9]+) (upgraded|packages to update)',
+                          str(line))
+        if count:
+            pending = int(count.group(1))
+            REGISTRY.set('naga_packages_pending', pending, host=hostname)
+            REGISTRY.set('naga_packages_upgraded',
+                         pending if succeeded else 0, host=hostname)
+            return
+
+
+def run_prefetch(hosts, config, workers=8):
+    '''
+    Stage pending upgrades concurrently across hosts, print staged hosts
+    :param hosts: list of hostnames
+    :param config: Connection Configuration object
+    :param workers: maximum number of hosts to prefetch at once
+    :return: list of staged hostnames
+    '''
+    staged = []
+    for name, out, ok in fleet_map(prefetch_host, hosts, config, workers):
+        print_out(out)
+        if ok:
+            staged.append(name)
+    missing = [name for name in hosts if name not in staged]
+    print(f'\n\n{len(staged)} of {len(hosts)} hosts fully staged.')
+    if missing:
+        print('Not staged:')
+        print_out(print_cols(missing))
+    return staged
+
+
+def run_plan(hosts, config, workers=8):
+    '''
+    Plan updates concurrently across hosts, print output and fleet table
+    :param hosts: list of hostnames
+    :param config: Connection Configuration object
+    :param workers: maximum number of hosts to check at once
+    :return: dict of hostname: plan dict
+    '''
+    plans = {}
+    for name, out, plan in fleet_map(plan_host, hosts, config, workers):
+        print_out(out)
+        plans[name] = plan
+    print('\n\nPending updates:')
+    print_out(plan_table(plans))
+    return plans
+
+
+def waves(hosts, canary=0, growth=2):
+    '''
+    Split hosts into a canary batch and geometrically growing batches
+    :param hosts: list of hostnames
+    :param canary: size of the first batch, 0 for a single batch
+    :param growth: factor each following batch grows by
+    :return: generator of lists of hostnames
+    '''
+    if canary < 1:
+        yield hosts
+        return
+    size = canary
+    while hosts:
+        yield hosts[:size]
+        hosts = hosts[size:]
+        size = max(1, math.ceil(size * growth))
+
+
+def setup(connect_timeout=10, persistent=False):
+    config = get_sudo(connect_timeout, persistent)
     hosts = db_fetch_hostlist('')
     return config, hosts
 
@@ -258,28 +1125,141 @@ def main(argv):
                         help="Hostname or \'all\'; \'shell\' for interactive mode")
     parser.add_argument("-db", "--database", type=str, default="hosts.db",
                         help="SQLite3 db file to use")
+    parser.add_argument("-cmd", "--command", type=str, nargs='+',
+                        help="admin.py function to execute, and its arguments")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue the last fleet run, skipping done work")
+    parser.add_argument("--plan", action="store_true",
+                        help="Check pending updates only, change nothing")
+    parser.add_argument("--prefetch", action="store_true",
+                        help="Download pending upgrades only, at low priority")
+    parser.add_argument("--skip-clean", action="store_true",
+                        help="Skip the updater where the cached plan is clean")
+    parser.add_argument("--plan-age", type=int, default=720,
+                        help="Minutes a cached plan or prefetch stays valid "
+                             "(default 720)")
+    parser.add_argument("--inventory", action="store_true",
+                        help="Refresh installed package inventories")
+    parser.add_argument("--package", type=str,
+                        help="Query inventoried hosts for a package")
+    parser.add_argument("--import", type=str, dest="import_file",
+                        help="Upsert hosts from a CSV/JSON/YAML inventory file")
+    parser.add_argument("--export", type=str,
+                        help="Write all hosts to a CSV/JSON/YAML inventory file")
+    parser.add_argument("-t", "--timeout", type=int, default=10,
+                        help="SSH connect timeout in seconds (default 10)")
+    parser.add_argument("--persistent", action="store_true",
+                        help="Run commands through one persistent shell per host")
+    parser.add_argument("--no-preflight", action="store_true",
+                        help="Skip SSH reachability probe before fleet runs")
+    parser.add_argument("--deadline", type=int,
+                        help="Minutes after which no further phases start")
+    parser.add_argument("--canary", type=int, default=0,
+                        help="Run in waves, starting with this many hosts")
+    parser.add_argument("--growth", type=float, default=2,
+                        help="Factor each following wave grows by (default 2)")
+    parser.add_argument("--threshold", type=float, default=0.9,
+                        help="Success rate a wave needs to continue (default 0.9)")
+    parser.add_argument("--summary", action="store_true",
+                        help="Group identical host results, anomalies first")
+    parser.add_argument("--metrics", type=str,
+                        help="Write run telemetry to this OpenMetrics file")
+    parser.add_argument("-w", "--workers", type=int, default=8,
+                        help="Hosts to process concurrently (default 8)")
     args = parser.parse_args()
     os.environ['CONN'] = args.database
+    db_create_db()
+    started = time.time()
     if args.host == "shell":
         NagaPrompt().cmdloop()
+    elif args.package:
+        print_out(package_query(args.package))
+    elif args.import_file or args.export:
+        if args.import_file:
+            print_out(import_hosts(args.import_file))
+        if args.export:
+            print_out(export_hosts(args.export))
+    elif args.plan or args.inventory or args.prefetch:
+        config = get_sudo(args.timeout, args.persistent)
+        if args.host == "all":
+            hosts = db_fetch_hostlist('')
+        else:
+            hosts = [db_fetch_hostname('', pick_host(args.host, "Which host? "))]
+        if not args.no_preflight:
+            hosts = preflight(hosts, config)
+        if args.plan:
+            run_plan(hosts, config, args.workers)
+        if args.prefetch:
+            run_prefetch(hosts, config, args.workers)
+        if args.inventory:
+            for out in fleet_map(inventory_host, hosts, config, args.workers):
+                print_out(out)
+    elif args.host == "all" and args.command:
+        config = get_sudo(args.timeout, args.persistent)
+        hosts = db_fetch_hostlist('')
+        if not args.no_preflight:
+            hosts = preflight(hosts, config)
+        for out in fleet_map(lambda host_id, config: command_host(
+                host_id, config, args.command[0], args.command[1:]),
+                hosts, config, args.workers):
+            print_out(out)
+    elif args.host == "all" and args.resume and db_fetch_job('') is None:
+        print('No fleet run to resume.')
+    elif args.host == "all" and args.resume and db_fetch_job('')['finished']:
+        print(f'Run {db_fetch_job("")["id"]} already finished on every host, '
+              f'nothing to resume.')
     elif args.host == "all":
-        reboot_list = []
-        config, hosts = setup()
-        for host in hosts:
-            host_id = db_fetch_hostid('', host)
-            flag = run_host(host_id, config)
-            if flag is True:
-                reboot_list.append(f'\t{host}')
+        if args.resume:
+            job = db_fetch_job('')
+            hosts = [host for host in job['hosts']
+                     if host in db_fetch_hostlist('')]
+            print(f'Resuming run {job["id"]}.')
+            config = get_sudo(args.timeout, args.persistent)
+        else:
+            config, hosts = setup(args.timeout, args.persistent)
+            job = db_fetch_job('', db_add_job('', hosts))
+        if not args.no_preflight:
+            hosts = preflight(hosts, config)
+        summary = Summarizer() if args.summary else None
+        deadline = None
+        if args.deadline:
+            deadline = started + args.deadline * 60
+        reboot_list = run_fleet(hosts, config, job, args.skip_clean,
+                                args.plan_age, args.workers, args.canary,
+                                args.growth, args.threshold, summary,
+                                deadline)
+        if summary is not None:
+            print()
+            print_out(summary.render())
         if len(reboot_list) > 0:
             print(f'\n\nThe following hosts need to be rebooted:')
-            print_out(reboot_list)
+            print_out([f'\t{host}' for host in reboot_list])
     else:
-        config = get_sudo()
         host_id = pick_host(args.host, "Which host? ")
-        flag = run_host(host_id, config)
+        hostname = db_fetch_hostname('', host_id)
+        if args.command:
+            request = {'command': args.command[0], 'args': args.command[1:],
+                       'hosts': [hostname]}
+        else:
+            request = {'command': 'run', 'hosts': [hostname]}
+        response = daemon_request(request)
+        if response is not None:
+            print_out(response['output'])
+            flag = hostname in response.get('reboot', [])
+        elif args.command:
+            config = get_sudo(args.timeout, args.persistent)
+            host = db_read_host('', host_id, config)
+            print_out(run_command(host, args.command[0], args.command[1:]))
+            flag = False
+        else:
+            config = get_sudo(args.timeout, args.persistent)
+            flag = run_host(host_id, config)
         if flag is True:
-            hostname = db_fetch_hostname('', host_id)
             print(f'\n\nHost {hostname} needs to be rebooted.')
+    if args.metrics:
+        REGISTRY.set('naga_run_duration_seconds', time.time() - started)
+        REGISTRY.set('naga_run_timestamp_seconds', time.time())
+        REGISTRY.write(args.metrics)
     # Clean up
     del os.environ['CONN']
 
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# report.py
+
+# Imports
+import re
+import threading
+
+
+ANOMALY = re.compile('failed|UnexpectedExit|command failure|unreachable|'
+                     'not clean|restart required|timed out', re.IGNORECASE)
+
+
+class Summarizer:
+    '''
+    Streaming fleet output reporter grouping hosts with identical results
+    Lines are normalized (host name replaced by <host>) as they arrive and
+    only one entry per distinct outcome is kept, with the hosts that had it.
+    :param live: print each new anomaly the first time it is seen
+    '''
+    def __init__(self, live=True):
+        self.live = live
+        self.lock = threading.Lock()
+        self.groups = {}
+        self.hosts = set()
+
+    def feed(self, hostname, out):
+        '''
+        Add a host's output lines to the summary
+        :param hostname: name of the host the lines came from
+        :param out: List of formatted strings
+        '''
+        if isinstance(out, str):
+            out = [out]
+        with self.lock:
+            self.hosts.add(hostname)
+            for line in out:
+                if not str(line).strip():
+                    continue
+                key = normalize(hostname, str(line))
+                hosts = self.groups.setdefault(key, {})
+                if hostname in hosts:
+                    continue
+                hosts[hostname] = None
+                if self.live and len(hosts) == 1 and ANOMALY.search(key):
+                    print(f'!! {line}')
+
+    def render(self, limit=8):
+        '''
+        Format one line per distinct outcome, anomalies first
+        :param limit: host names listed per outcome before truncating;
+                      anomalies always list every host
+        :return: List of formatted strings
+        '''
+        with self.lock:
+            groups = sorted(((line, list(hosts))
+                             for line, hosts in self.groups.items()),
+                            key=lambda item: (not ANOMALY.search(item[0]),
+                                              -len(item[1]), item[0]))
+            total = len(self.hosts)
+        out = [f'Summary of {total} hosts:']
+        section = None
+        for line, hosts in groups:
+            anomaly = bool(ANOMALY.search(line))
+            if anomaly != section:
+                section = anomaly
+                out.append('Anomalies:' if anomaly else 'Results:')
+            if len(hosts) == total and not anomaly:
+                names = 'all hosts'
+            elif anomaly or len(hosts) <= limit:
+                names = ', '.join(hosts)
+            else:
+                names = (', '.join(hosts[:limit]) +
+                         f' (+{len(hosts) - limit} more)')
+            out.append(f'{len(hosts):>6}  {line}  [{names}]')
+        return out
+
+
+def normalize(hostname, line):
+    '''
+    Replace the host name in an output line with a placeholder
+    :param hostname: name of the host the line came from
+    :param line: formatted output string
+    :return: normalized string
+    '''
+    pattern = r'(?<![\w.-])' + re.escape(hostname) + r'(?![\w.-])'
+    return re.sub(pattern, '<host>', line).strip()
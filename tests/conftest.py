@@ -0,0 +1,20 @@
+# conftest.py
+
+# Imports
+from pathlib import Path
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from backend import db_create_db
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    '''Empty naga database in a temp dir, selected through CONN'''
+    monkeypatch.setenv('CONN', str(tmp_path / 'hosts.db'))
+    db_create_db()
+    return os.environ['CONN']
@@ -0,0 +1,111 @@
+# test_hostfile.py
+
+# Imports
+import json
+
+import pytest
+
+from backend import db_export_hosts, db_fetch_apps, db_fetch_hostid,\
+                    db_fetch_parent_id, db_import_hosts
+import hostfile
+import naga
+
+
+CSV = '''name,updater,apps,parent
+pve1,apt_all,,
+vm1,apt_all,git_all pihole_up,pve1
+mac,brew_all,,
+'''
+
+
+def write(tmp_path, name, text):
+    path = tmp_path / name
+    path.write_text(text)
+    return str(path)
+
+
+def record(name, updater='apt_all', apps=(), parent=''):
+    return {'name': name, 'updater': updater, 'apps': list(apps),
+            'parent': parent}
+
+
+def test_read_csv(tmp_path):
+    records = hostfile.read_hosts(write(tmp_path, 'hosts.csv', CSV))
+    assert records == [record('pve1'),
+                       record('vm1', apps=['git_all', 'pihole_up'],
+                              parent='pve1'),
+                       record('mac', updater='brew_all')]
+
+
+def test_read_json_defaults(tmp_path):
+    text = json.dumps({'hosts': [{'name': ' web '}, {'name': 'db',
+                                                     'apps': 'git_all'}]})
+    records = hostfile.read_hosts(write(tmp_path, 'hosts.json', text))
+    assert records == [record('web'), record('db', apps=['git_all'])]
+
+
+def test_read_duplicates(tmp_path):
+    path = write(tmp_path, 'hosts.csv', CSV + 'vm1,apt_all,,\n')
+    with pytest.raises(hostfile.HostFileError, match='duplicate hosts vm1'):
+        hostfile.read_hosts(path)
+
+
+def test_read_bad_input(tmp_path):
+    with pytest.raises(hostfile.HostFileError, match='no name'):
+        hostfile.read_hosts(write(tmp_path, 'hosts.json', '[{"apps": []}]'))
+    with pytest.raises(hostfile.HostFileError):
+        hostfile.read_hosts(write(tmp_path, 'hosts.json', '{not json'))
+    with pytest.raises(hostfile.HostFileError, match='.csv, .json'):
+        hostfile.read_hosts(write(tmp_path, 'hosts.txt', CSV))
+
+
+def test_import_adds(db):
+    out = db_import_hosts('', [record('pve1'),
+                               record('vm1', apps=['git_all'],
+                                      parent='pve1')])
+    assert out == ['+ pve1: added, apt_all',
+                   '+ vm1: added, apt_all git_all',
+                   '~ vm1: parent - -> pve1']
+    vm1 = db_fetch_hostid('', 'vm1')
+    assert db_fetch_apps('', vm1) == ['git_all']
+    assert db_fetch_parent_id('', vm1) == db_fetch_hostid('', 'pve1')
+
+
+def test_import_diff(db):
+    db_import_hosts('', [record('pve1'), record('pve2'),
+                         record('vm1', apps=['git_all', 'pihole_up'],
+                                parent='pve1')])
+    assert db_import_hosts('', [record('pve1'), record('pve2'),
+                                record('vm1', apps=['git_all', 'pihole_up'],
+                                       parent='pve1')]) == []
+    out = db_import_hosts('', [record('vm1', updater='brew_all',
+                                      apps=['pihole_up'], parent='pve2')])
+    assert out == ['~ vm1: updater apt_all -> brew_all',
+                   '~ vm1: apps git_all pihole_up -> pihole_up',
+                   '~ vm1: parent pve1 -> pve2']
+    vm1 = db_fetch_hostid('', 'vm1')
+    assert db_fetch_parent_id('', vm1) == db_fetch_hostid('', 'pve2')
+    assert {host['name']: host['parent'] for host in db_export_hosts('')} \
+        == {'pve1': '', 'pve2': '', 'vm1': 'pve2'}
+
+
+def test_round_trip(db, tmp_path):
+    assert naga.import_hosts(write(tmp_path, 'hosts.csv', CSV))[-1].endswith(
+        '3 hosts, 4 changes')
+    exported = str(tmp_path / 'export.csv')
+    assert naga.export_hosts(exported) == [f'Exported 3 hosts to {exported}']
+    assert sorted(hostfile.read_hosts(exported), key=lambda r: r['name']) == \
+        sorted(hostfile.read_hosts(str(tmp_path / 'hosts.csv')),
+               key=lambda r: r['name'])
+    assert naga.import_hosts(exported) == \
+        [f'{exported}: 3 hosts, no changes']
+
+
+def test_import_unknown_parent(db, tmp_path):
+    text = json.dumps([record('vm1', parent='nowhere'),
+                       record('vm2', updater='no_such_function')])
+    out = naga.import_hosts(write(tmp_path, 'hosts.json', text))
+    assert out == ['Import failed, nothing written:',
+                   'vm1: unknown parent nowhere',
+                   'vm2: no admin function no_such_function']
+    assert db_export_hosts('') == []
@@ -0,0 +1,46 @@
+# test_naga.py
+
+# Imports
+import admin
+import naga
+
+
+def test_waves_single_batch():
+    hosts = [f'h{n}' for n in range(5)]
+    assert list(naga.waves(hosts)) == [hosts]
+    assert list(naga.waves(hosts, canary=0, growth=3)) == [hosts]
+    assert list(naga.waves([])) == [[]]
+
+
+def test_waves_canary():
+    hosts = [f'h{n}' for n in range(10)]
+    assert list(naga.waves(hosts, canary=1)) == \
+        [hosts[:1], hosts[1:3], hosts[3:7], hosts[7:]]
+    assert list(naga.waves(hosts, canary=2, growth=1.5)) == \
+        [hosts[:2], hosts[2:5], hosts[5:10]]
+    assert list(naga.waves(hosts, canary=20)) == [hosts]
+    assert list(naga.waves([], canary=1)) == []
+
+
+def test_waves_never_shrinks_below_one():
+    hosts = [f'h{n}' for n in range(3)]
+    assert list(naga.waves(hosts, canary=1, growth=0)) == \
+        [hosts[:1], hosts[1:2], hosts[2:]]
+
+
+def test_phase_order_resources():
+    assert naga.phase_order([]) == []
+    # apt_all and pihole_up share the package manager, git_all needs nothing
+    assert naga.phase_order(['apt_all', 'git_all', 'pihole_up']) == \
+        [set(), set(), {0}]
+    assert naga.phase_order(['git_all', 'version_check', 'no_such']) == \
+        [set(), set(), set()]
+
+
+def test_phase_order_exclusive(monkeypatch):
+    def custom(host):
+        return []
+    monkeypatch.setattr(admin, 'custom', custom, raising=False)
+    assert naga.phase_order(['apt_all', 'git_all', 'pihole_up', 'custom',
+                             'git_all']) == \
+        [set(), set(), {0}, {0, 1, 2}, {3}]
@@ -0,0 +1,185 @@
+# test_persistent.py
+
+# Imports
+import os
+import subprocess
+import threading
+import time
+
+from invoke.exceptions import CommandTimedOut, UnexpectedExit
+from fabric import Config
+import pytest
+
+import backend
+
+
+class LocalChannel:
+    '''paramiko Channel stand-in running its command in a local sh'''
+
+    def __init__(self):
+        self.closed = False
+        self.command = None
+        self.buffers = {'out': b'', 'err': b''}
+        self.lock = threading.Lock()
+        self.wake_read, self.wake_write = os.pipe()
+        os.set_blocking(self.wake_read, False)
+
+    def exec_command(self, command):
+        self.command = command
+        # The local user needs no password: run the elevated shell as is
+        command = command.replace("sudo -S -H -p '[sudo] naga password: ' ",
+                                  '')
+        self.process = subprocess.Popen(
+            command, shell=True, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        for stream, key in ((self.process.stdout, 'out'),
+                            (self.process.stderr, 'err')):
+            threading.Thread(target=self.pump, args=(stream, key),
+                             daemon=True).start()
+
+    def pump(self, stream, key):
+        for data in iter(lambda: os.read(stream.fileno(), 4096), b''):
+            with self.lock:
+                self.buffers[key] += data
+            os.write(self.wake_write, b'.')
+
+    def take(self, key, size):
+        try:
+            os.read(self.wake_read, 4096)
+        except BlockingIOError:
+            pass
+        with self.lock:
+            data = self.buffers[key][:size]
+            self.buffers[key] = self.buffers[key][size:]
+        return data
+
+    def sendall(self, data):
+        self.process.stdin.write(data if isinstance(data, bytes)
+                                 else data.encode())
+        self.process.stdin.flush()
+
+    def recv_ready(self):
+        return bool(self.buffers['out'])
+
+    def recv_stderr_ready(self):
+        return bool(self.buffers['err'])
+
+    def recv(self, size):
+        return self.take('out', size)
+
+    def recv_stderr(self, size):
+        return self.take('err', size)
+
+    def exit_status_ready(self):
+        return (self.process.poll() is not None and
+                not self.recv_ready() and not self.recv_stderr_ready())
+
+    def recv_exit_status(self):
+        return self.process.wait()
+
+    def fileno(self):
+        return self.wake_read
+
+    def close(self):
+        self.closed = True
+        self.process.kill()
+        self.process.wait()
+
+
+class LocalTransport:
+    def __init__(self):
+        self.sessions = []
+
+    def open_session(self):
+        self.sessions.append(LocalChannel())
+        return self.sessions[-1]
+
+
+class LocalConnection:
+    '''HostConnection stand-in whose shells are local processes'''
+
+    def __init__(self):
+        self.config = Config(overrides={'sudo': {'password': 'secret'}})
+        self.transport = LocalTransport()
+        self.command_timeout = None
+        self.opened = 0
+
+    def open(self):
+        self.opened += 1
+
+    def close(self):
+        pass
+
+    def limited(self, command, timeout):
+        timeout = timeout or self.command_timeout
+        if timeout is None:
+            return command, None
+        return backend.remote_timeout(command, timeout), timeout
+
+
+@pytest.fixture
+def shell():
+    conn = backend.PersistentShell(LocalConnection())
+    yield conn
+    conn.close()
+
+
+def test_framing(shell):
+    result = shell.run('echo one; echo two >&2; printf three', hide=True)
+    assert result.stdout == 'one\nthree'
+    assert result.stderr == 'two\n'
+    assert result.exited == 0
+    assert shell.run('true', hide=True).stdout == ''
+    # Output that looks like a frame of another command is passed through
+    result = shell.run('printf "\\n__naga_x__ 1\\n"', hide=True)
+    assert result.stdout == '\n__naga_x__ 1\n'
+
+
+def test_reuses_shell(shell):
+    shell.run('cd /; X=1', hide=True)
+    # Each command runs in a child sh of one long-lived shell
+    assert shell.run('echo "$X"', hide=True).stdout == '\n'
+    shell.run('cat', hide=True)
+    assert shell.run('echo still here', hide=True).stdout == 'still here\n'
+    assert len(shell.conn.transport.sessions) == 1
+
+
+def test_sudo_shell(shell):
+    assert shell.sudo('echo root', hide=True).stdout == 'root\n'
+    assert shell.run('echo user', hide=True).stdout == 'user\n'
+    assert shell.sudo('echo again', hide=True).stdout == 'again\n'
+    sessions = shell.conn.transport.sessions
+    assert len(sessions) == 2
+    assert sessions[0].command.startswith('sudo -S -H')
+
+
+def test_exit_codes(shell):
+    with pytest.raises(UnexpectedExit) as raised:
+        shell.run('echo failed >&2; exit 3', hide=True)
+    assert raised.value.result.exited == 3
+    assert raised.value.result.stderr == 'failed\n'
+    result = shell.run('exit 4', hide=True, warn=True)
+    assert result.exited == 4
+    # A failing command leaves the shell usable
+    assert shell.run('echo ok', hide=True).stdout == 'ok\n'
+    assert len(shell.conn.transport.sessions) == 1
+
+
+def test_timeout(shell):
+    started = time.time()
+    with pytest.raises(CommandTimedOut):
+        shell.run('sleep 10', hide=True, timeout=0.5)
+    assert time.time() - started < 5
+    first = shell.conn.transport.sessions[0]
+    assert first.closed
+    # The next command starts over on a new shell
+    assert shell.run('echo back', hide=True).stdout == 'back\n'
+    assert len(shell.conn.transport.sessions) == 2
+
+
+def test_command_timeout(shell):
+    shell.command_timeout = 0.5
+    with pytest.raises(CommandTimedOut):
+        shell.run('sleep 10', hide=True)
+    shell.command_timeout = None
+    assert shell.run('sleep 0.1; echo done', hide=True).stdout == 'done\n'
@@ -0,0 +1,177 @@
+# test_transfer.py
+
+# Imports
+from types import SimpleNamespace
+import os
+import stat
+import subprocess
+
+from paramiko import ssh_exception
+import pytest
+
+import transfer
+
+
+CHUNK = 1 << 12
+
+
+class FakeFile:
+    '''SFTPFile stand-in on a local file, dropping the link on request'''
+
+    def __init__(self, path, mode, drops):
+        self.file = open(path, mode)
+        self.drops = drops
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.file.close()
+
+    def set_pipelined(self, pipelined):
+        pass
+
+    def truncate(self, size):
+        self.file.truncate(size)
+
+    def seek(self, offset):
+        self.file.seek(offset)
+
+    def write(self, data):
+        self.file.write(data)
+        if self.drops and self.file.tell() > self.drops[0]:
+            self.drops.pop(0)
+            raise EOFError('link dropped')
+
+
+class FakeSFTP:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def stat(self, path):
+        return os.stat(path)
+
+    def open(self, path, mode):
+        self.conn.modes.append(mode)
+        return FakeFile(path, mode, self.conn.drops)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    '''Host connection whose "remote" side is the local filesystem'''
+
+    def __init__(self, drops=()):
+        self.drops = list(drops)
+        self.modes = []
+        self.opened = 0
+        self.client = SimpleNamespace(open_sftp=lambda: FakeSFTP(self))
+
+    def open(self):
+        self.opened += 1
+
+    def run(self, command, hide=False):
+        result = subprocess.run(command, shell=True, capture_output=True,
+                                text=True, check=True)
+        return SimpleNamespace(stdout=result.stdout)
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / 'source'
+    # Compressible text with random blocks, several chunks long
+    path.write_bytes(b''.join(os.urandom(64) if n % 3 else b'naga ' * 40
+                              for n in range(600)))
+    path.chmod(0o750)
+    return path
+
+
+def test_resume_point_no_part(tmp_path, source):
+    conn = FakeConnection()
+    part = str(tmp_path / 'missing.naga-part')
+    assert transfer.resume_point(conn, FakeSFTP(conn), source, part, CHUNK,
+                                 False) == (0, 0)
+
+
+def test_resume_point_partial(tmp_path, source):
+    conn = FakeConnection()
+    part = tmp_path / 'dest.naga-part'
+    data = source.read_bytes()
+    # Two whole chunks and part of a third: resume after the second
+    part.write_bytes(data[:2 * CHUNK + 100])
+    assert transfer.resume_point(conn, FakeSFTP(conn), source, str(part),
+                                 CHUNK, False) == (2, 2 * CHUNK)
+    # Less than one chunk: start over
+    part.write_bytes(data[:100])
+    assert transfer.resume_point(conn, FakeSFTP(conn), source, str(part),
+                                 CHUNK, False) == (0, 0)
+    # Corrupt data fails the hash check: start over
+    part.write_bytes(b'x' * (3 * CHUNK))
+    assert transfer.resume_point(conn, FakeSFTP(conn), source, str(part),
+                                 CHUNK, False) == (0, 0)
+
+
+def test_resume_point_compressed(tmp_path, source):
+    conn = FakeConnection()
+    part = tmp_path / 'dest.naga-part'
+    members = list(transfer.chunks(source, CHUNK, True))
+    part.write_bytes(b''.join(members[:3]) + members[3][:10])
+    assert transfer.resume_point(conn, FakeSFTP(conn), source, str(part),
+                                 CHUNK, True) == \
+        (3, sum(len(member) for member in members[:3]))
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_upload(tmp_path, source, compress):
+    conn = FakeConnection()
+    remote = tmp_path / 'dest'
+    stats = transfer.upload(conn, source, str(remote), compress,
+                            chunk_size=CHUNK, backoff=0)
+    assert remote.read_bytes() == source.read_bytes()
+    assert stat.S_IMODE(remote.stat().st_mode) == 0o750
+    assert not (tmp_path / 'dest.naga-part').exists()
+    assert stats['size'] == source.stat().st_size
+    assert stats['resumed'] == 0 and stats['retries'] == 0
+    if compress:
+        assert stats['sent'] < stats['size']
+    else:
+        assert stats['sent'] == stats['size']
+    assert transfer.describe(stats).endswith('sha256 verified')
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_upload_resumes(tmp_path, source, compress):
+    wire = sum(map(len, transfer.chunks(source, CHUNK, compress)))
+    conn = FakeConnection(drops=[wire // 4, wire // 2])
+    remote = tmp_path / 'dest'
+    stats = transfer.upload(conn, source, str(remote), compress,
+                            chunk_size=CHUNK, backoff=0)
+    assert remote.read_bytes() == source.read_bytes()
+    assert stats['retries'] == 2
+    assert stats['resumed'] > 0
+    assert conn.opened == 3
+    assert conn.modes[0] == 'wb' and conn.modes[1:] == ['r+b', 'r+b']
+
+
+def test_upload_gives_up(tmp_path, source):
+    conn = FakeConnection(drops=[0] * 5)
+    with pytest.raises(EOFError):
+        transfer.upload(conn, source, str(tmp_path / 'dest'),
+                        chunk_size=CHUNK, retries=2, backoff=0)
+    assert conn.opened == 3
+    assert not (tmp_path / 'dest').exists()
+
+
+def test_upload_host_gone(tmp_path, source):
+    conn = FakeConnection()
+
+    def unreachable():
+        conn.opened += 1
+        raise ssh_exception.NoValidConnectionsError({('10.0.0.1', 22):
+                                                     OSError('refused')})
+    conn.open = unreachable
+    with pytest.raises(ssh_exception.NoValidConnectionsError):
+        transfer.upload(conn, source, str(tmp_path / 'dest'),
+                        chunk_size=CHUNK, backoff=0)
+    assert conn.opened == 1
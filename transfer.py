@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# transfer.py
+
+# Imports
+from paramiko import ssh_exception
+from pathlib import Path
+import gzip
+import hashlib
+import shlex
+import time
+
+
+HASH = 'command -v sha256sum >/dev/null && H=sha256sum || H="shasum -a 256";'
+
+
+class TransferError(Exception):
+    '''Upload could not be completed or failed verification'''
+
+
+def chunks(path, chunk_size, compress, start=0):
+    '''
+    Read local file in chunks, each gzip-compressed on its own if asked
+    Independent gzip members concatenate into one valid gzip stream, so
+    every chunk boundary is also a valid resume point on the remote side.
+    :param path: local Path
+    :param chunk_size: bytes of the original file per chunk
+    :param compress: gzip each chunk
+    :param start: index of first chunk to read
+    :return: generator of bytes
+    '''
+    with open(path, 'rb') as f:
+        f.seek(start * chunk_size)
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                return
+            if compress:
+                data = gzip.compress(data, mtime=0)
+            yield data
+
+
+def file_digest(path):
+    '''
+    sha256 of local file
+    :param path: local Path
+    :return: hex digest string
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def remote_digest(conn, remote, size=None):
+    '''
+    sha256 of remote file, or of its first size bytes
+    :param conn: Host connection object
+    :param remote: remote path
+    :param size: only hash this many leading bytes
+    :return: hex digest string
+    '''
+    if size is None:
+        command = f'{HASH} $H {shlex.quote(remote)}'
+    else:
+        command = f'{HASH} head -c {size} {shlex.quote(remote)} | $H'
+    return conn.run(command, hide=True).stdout.split()[0]
+
+
+def resume_point(conn, sftp, path, part, chunk_size, compress):
+    '''
+    Find the last chunk boundary up to which the remote partial file
+    matches the local data, verified by hash
+    :param conn: Host connection object
+    :param sftp: open SFTPClient on conn
+    :param path: local Path
+    :param part: remote partial file path
+    :param chunk_size: bytes of the original file per chunk
+    :param compress: chunks are gzip-compressed
+    :return: number of chunks already on the remote side, bytes they hold
+    '''
+    try:
+        remote_size = sftp.stat(part).st_size
+    except IOError:
+        return 0, 0
+    count = offset = 0
+    digest = hashlib.sha256()
+    for data in chunks(path, chunk_size, compress):
+        if offset + len(data) > remote_size:
+            break
+        digest.update(data)
+        count += 1
+        offset += len(data)
+    if offset and remote_digest(conn, part, offset) == digest.hexdigest():
+        return count, offset
+    return 0, 0
+
+
+def send(conn, path, part, chunk_size, compress):
+    '''
+    Write the chunks the remote partial file is missing, over a new SFTP
+    session (a dropped transport is reconnected first)
+    :param conn: Host connection object
+    :param path: local Path
+    :param part: remote partial file path
+    :param chunk_size: bytes of the original file per chunk
+    :param compress: gzip chunks on the fly
+    :return: bytes already on the remote side, bytes sent
+    '''
+    conn.open()
+    sftp = conn.client.open_sftp()
+    try:
+        count, offset = resume_point(conn, sftp, path, part, chunk_size,
+                                     compress)
+        sent = 0
+        with sftp.open(part, 'r+b' if count else 'wb') as f:
+            f.set_pipelined(True)
+            if count:
+                f.truncate(offset)
+                f.seek(offset)
+            for data in chunks(path, chunk_size, compress, count):
+                f.write(data)
+                sent += len(data)
+    finally:
+        sftp.close()
+    return offset, sent
+
+
+def upload(conn, local, remote, compress=False, chunk_size=1 << 20,
+           retries=3, backoff=2):
+    '''
+    Chunked, resumable, optionally compressed upload with end-to-end check
+    Data goes to remote + '.naga-part' first; when the link drops, the
+    upload resumes from the last chunk verified there, up to retries times.
+    The finished file is moved (or decompressed) into place and its sha256
+    compared with the local file.
+    :param conn: Host connection object
+    :param local: local file path
+    :param remote: remote destination path
+    :param compress: gzip chunks on the fly, decompress remotely
+    :param chunk_size: bytes of the original file per chunk
+    :param retries: attempts to resume after a failed one
+    :param backoff: seconds before the first retry, doubling after each
+    :return: dict of transfer statistics
+    '''
+    path = Path(local).expanduser()
+    compress = compress and path.stat().st_size > 0
+    part = f'{remote}.naga-part'
+    started = time.time()
+    for attempt in range(retries + 1):
+        try:
+            offset, sent = send(conn, path, part, chunk_size, compress)
+            break
+        except ssh_exception.NoValidConnectionsError:
+            # Host is gone (and its circuit breaker open), retrying won't help
+            raise
+        except (OSError, EOFError, ssh_exception.SSHException):
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+    if compress:
+        conn.run(f'gzip -dc {shlex.quote(part)} > {shlex.quote(remote)} && '
+                 f'rm -f {shlex.quote(part)}', hide=True)
+    else:
+        conn.run(f'mv -f {shlex.quote(part)} {shlex.quote(remote)}',
+                 hide=True)
+    conn.run(f'chmod {path.stat().st_mode & 0o7777:o} {shlex.quote(remote)}',
+             hide=True)
+    if remote_digest(conn, remote) != file_digest(path):
+        raise TransferError(f'{remote}: checksum mismatch after upload')
+    elapsed = max(time.time() - started, 0.001)
+    return {'size': path.stat().st_size, 'sent': sent, 'resumed': offset,
+            'wire': offset + sent, 'seconds': elapsed,
+            'rate': sent / elapsed, 'retries': attempt}
+
+
+def describe(stats):
+    '''
+    Format transfer statistics for output
+    :param stats: dict from upload()
+    :return: formatted string
+    '''
+    out = (f'{stats["size"]} bytes, {stats["sent"]} sent in '
+           f'{stats["seconds"]:.1f}s ({stats["rate"] / 1024:.1f} KiB/s)')
+    if stats['wire'] != stats['size'] and stats['size']:
+        out += f', {stats["wire"] / stats["size"]:.0%} of original compressed'
+    if stats['retries']:
+        out += f', {stats["retries"]} retries'
+    if stats['resumed']:
+        out += f', resumed at {stats["resumed"]} bytes'
+    return out + ', sha256 verified'